@@ -3,14 +3,241 @@
 
 import argparse
 import os
-import pprint
+import runpy
 import stat
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from pathlib import Path
+from string import Template
+from tempfile import TemporaryDirectory
 
 import flywheel
 
+# Max number of containers kept by a ContainerResolver
+CONTAINER_CACHE_SIZE = 4096
 
-def get_container_path(fw, group_id, project_label, destination):
-    """Get path to container that can be found by fw.lookup()."""
+# Number of jobs fetched at once in batch mode
+BATCH_WORKERS = 8
+
+# Line length of the generated scripts, as black's
+LINE_LENGTH = 88
+
+SCRIPT_TEMPLATE = Template(
+    '''#! /usr/bin/env python3
+"""Run $gear_name on $destination_type "$destination_label"
+
+This script was created to run Job ID $job_id
+In project "$group_id/$project_label"
+On Flywheel Instance $api_url
+"""
+
+import os
+import argparse
+from datetime import datetime
+
+
+import flywheel
+
+destination_path = $destination_path
+
+input_files = $input_files
+
+
+def find_analysis(fw, parent_path, file_name, analyses_by_file):
+    """Return the first analysis of the container at parent_path with file_name.
+
+    The analyses of each parent are only listed once, into analyses_by_file.
+    """
+    if parent_path not in analyses_by_file:
+        analyses_by_file[parent_path] = dict()
+        for analysis in fw.lookup(parent_path).reload().analyses:
+            for file in analysis.files:
+                analyses_by_file[parent_path].setdefault(file.name, analysis)
+    return analyses_by_file[parent_path].get(file_name)
+
+
+def get_input(fw, val, analyses_by_file):
+    """Return the file of an input_files entry, or None if it cannot be found."""
+    if "analysis_id" in val:
+        container = fw.get_analysis(val["analysis_id"])
+    elif val["container_path"][:8] == "analysis":
+        path = val["container_path"][9:]
+        container = find_analysis(fw, path, val["location_name"], analyses_by_file)
+        if container is None:
+            return None
+    else:
+        container = fw.lookup(val["container_path"])
+    # the file of the original job, unless the container has changed
+    files = {file.file_id: file for file in container.files}
+    return files.get(val.get("file_id")) or container.get_file(val["location_name"])
+
+
+def main(fw):
+
+    gear = fw.lookup("gears/$gear_name")
+    print("gear.gear.version in original job was = $gear_version")
+    print(f"gear.gear.version now = {gear.gear.version}")
+    print("destination_id = $destination_id")
+    print("destination type is: $destination_type")
+    destination = fw.lookup(destination_path)
+
+    inputs = dict()
+    analyses_by_file = dict()
+    for key, val in input_files.items():
+        inputs[key] = get_input(fw, val, analyses_by_file)
+
+    config = $config
+
+    tags = $tags
+
+$run
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    args = parser.parse_args()
+
+    fw = flywheel.Client("")
+    print(fw.get_config().site.api_url)
+
+    analysis_id = main(fw)
+
+    os.sys.exit(0)
+'''
+)
+
+RUN_ANALYSIS_TEMPLATE = '''    now = datetime.now()
+    analysis_label = (
+        f'{gear.gear.name} {now.strftime("%m-%d-%Y %H:%M:%S")} SDK launched'
+    )
+    print(f"analysis_label = {analysis_label}")
+
+    analysis_id = gear.run(
+        analysis_label=analysis_label,
+        tags=tags,
+        config=config,
+        inputs=inputs,
+        destination=destination,
+    )
+    print(f"analysis_id = {analysis_id}")
+    return analysis_id
+'''
+
+RUN_JOB_TEMPLATE = '''    job_id = gear.run(tags=tags, config=config, inputs=inputs, destination=destination)
+    print(f"job_id = {job_id}")
+    return job_id
+'''
+
+LAUNCHER_TEMPLATE = Template(
+    '''#! /usr/bin/env python3
+"""Run the $num_scripts jobs copied by copy-job.py"""
+
+import os
+import runpy
+
+import flywheel
+
+scripts = $scripts
+
+if __name__ == "__main__":
+
+    fw = flywheel.Client("")
+    print(fw.get_config().site.api_url)
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    for script in scripts:
+        print(f"Running {script}")
+        runpy.run_path(os.path.join(here, script))["main"](fw)
+
+    os.sys.exit(0)
+'''
+)
+
+
+class ContainerResolver:
+    """Fetch containers and gears by ID, keeping the most recently used ones in memory.
+
+    One resolver is meant to be shared by all the lookups of a run, so each parent
+    container or gear is only fetched once however many jobs, destinations and inputs
+    share it, even when looked up from several threads at once.
+    """
+
+    def __init__(self, fw, maxsize=CONTAINER_CACHE_SIZE):
+        self.fw = fw
+        self.maxsize = maxsize
+        self.api_calls = 0
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, container_id):
+        """Get any container, like fw.get()."""
+        return self._get(container_id, self.fw.get)
+
+    def get_project(self, project_id):
+        return self._get(project_id, self.fw.get_project)
+
+    def get_subject(self, subject_id):
+        return self._get(subject_id, self.fw.get_subject)
+
+    def get_session(self, session_id):
+        return self._get(session_id, self.fw.get_session)
+
+    def get_analysis(self, analysis_id):
+        return self._get(analysis_id, self.fw.get_analysis)
+
+    def get_gear(self, gear_id):
+        return self._get(gear_id, self.fw.get_gear)
+
+    def _get(self, container_id, fetch):
+        with self._lock:
+            future = self._cache.get(container_id)
+            fetching = future is None
+            if fetching:
+                # Other threads wait for this fetch instead of fetching again
+                future = Future()
+                self.api_calls += 1
+                self._put(container_id, future)
+            else:
+                self._cache.move_to_end(container_id)
+
+        if fetching:
+            try:
+                future.set_result(fetch(container_id))
+            except Exception as exc:
+                with self._lock:
+                    self._cache.pop(container_id, None)
+                future.set_exception(exc)
+        return future.result()
+
+    def _put(self, container_id, future):
+        self._cache[container_id] = future
+        if len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+
+
+def session_subject(resolver, session, subject_id):
+    """Get the subject of a session, as embedded in it if it is, else fetched.
+
+    The embedded subject is partial, so it is not cached by the resolver.
+    """
+    subject = getattr(session, "subject", None)
+    if subject is not None and getattr(subject, "label", None) is not None:
+        return subject
+    return resolver.get_subject(subject_id)
+
+
+def get_container_path(fw, group_id, project_label, destination, resolver=None):
+    """Get path to container that can be found by fw.lookup().
+
+    Parent subjects and sessions are fetched through `resolver`, if given, so they
+    are only fetched once per run. The subject of a session is read from the
+    session, which comes with its label.
+    """
+
+    if resolver is None:
+        resolver = ContainerResolver(fw)
 
     container_path = "Invalid"
     subject = None
@@ -29,8 +256,8 @@ def get_container_path(fw, group_id, project_label, destination):
         )
 
     elif isinstance(destination, flywheel.models.ContainerAcquisitionOutput):
-        subject = fw.get_subject(destination.parents.subject)
-        session = fw.get_session(destination.parents.session)
+        session = resolver.get_session(destination.parents.session)
+        subject = session_subject(resolver, session, destination.parents.subject)
         container_path = (
             f"{group_id}/{project_label}/{subject.label}/{session.label}/"
             + f"{destination.label}"
@@ -42,12 +269,12 @@ def get_container_path(fw, group_id, project_label, destination):
             container_path = f"{group_id}/{project_label}/analyses/{destination.label}"
 
         elif destination.parent.type == "subject":
-            subject = fw.get_subject(destination.parents.subject)
+            subject = resolver.get_subject(destination.parents.subject)
             container_path = f"{group_id}/{project_label}/{subject.label}/analyses/{destination.label}"
 
         elif destination.parent.type == "session":
-            subject = fw.get_subject(destination.parents.subject)
-            session = fw.get_session(destination.parents.session)
+            session = resolver.get_session(destination.parents.session)
+            subject = session_subject(resolver, session, destination.parents.subject)
             container_path = (
                 f"{group_id}/{project_label}/{subject.label}/{session.label}/analyses/{destination.label}"
             )
@@ -67,179 +294,545 @@ def get_container_path(fw, group_id, project_label, destination):
     return container_path
 
 
-def main(job_id):
+def collect_job(fw, job_id, api_url, analysis=False, resolver=None, verbose=True):
+    """Fetch what is needed to write a script re-running a job.
 
-    fw = flywheel.Client("")
-    print("Flywheel Instance", fw.get_config().site.api_url)
+    Gears and containers are fetched through `resolver`, if given, so they are only
+    fetched once when collecting many jobs.
+
+    Returns:
+        dict: The job, its gear, destination, container paths and inputs.
+    """
 
-    analysis = None
-    if args.analysis:
-        analysis = fw.get_analysis(job_id)
-        print(f"Getting job_id from analysis '{analysis.label}'")
+    say = print if verbose else lambda *args: None
+    if resolver is None:
+        resolver = ContainerResolver(fw)
+
+    if analysis:
+        analysis = resolver.get_analysis(job_id)
+        say(f"Getting job_id from analysis '{analysis.label}'")
         job_id = analysis.job.id
 
-    print("Job ID", job_id)
+    say("Job ID", job_id)
     job = fw.get_job(job_id)
-    gear = fw.get_gear(job.gear_id)
+    gear = resolver.get_gear(job.gear_id)
     gear_name = gear.gear.name
-    print(f"gear.gear.name is {gear_name}")
+    say(f"gear.gear.name is {gear_name}")
     destination_id = job.destination.id
     destination_type = job.destination.type
-    print(f"job's destination_id is {destination_id} type {destination_type}")
+    say(f"job's destination_id is {destination_id} type {destination_type}")
 
     if job.destination.type == "analysis":
-        analysis = fw.get_analysis(destination_id)
+        analysis = resolver.get_analysis(destination_id)
         destination_id = analysis.parent.id
         destination_type = analysis.parent.type
-        print(f"job's analysis's parent id is {destination_id} type {destination_type}")
+        say(f"job's analysis's parent id is {destination_id} type {destination_type}")
 
-    destination = fw.get(destination_id)
+    destination = resolver.get(destination_id)
     destination_label = destination.label
-    print(f"new job's destination is {destination_label} type {destination_type}")
+    say(f"new job's destination is {destination_label} type {destination_type}")
 
     group_id = destination.parents.group
-    print(f"Group id: {group_id}")
+    say(f"Group id: {group_id}")
 
     if destination_type == "project":
         project = destination
     else:
-        project = fw.get_project(destination.parents.project)
+        project = resolver.get_project(destination.parents.project)
     project_label = project.label
-    print(f"Project label: {project.label}")
+    say(f"Project label: {project.label}")
 
     script_name = f"{gear_name}_{destination_type}_{destination.label}.py"
     script_name = script_name.replace(" ", "_")
-    print(f"Creating script: {script_name} ...\n")
 
-    container_path = get_container_path(fw, group_id, project_label, destination)
+    container_path = get_container_path(
+        fw, group_id, project_label, destination, resolver=resolver
+    )
 
     input_files = dict()
     for key, val in job.config.get("inputs").items():
         if "hierarchy" in val:
-            input_container = fw.get(val["hierarchy"]["id"])
+            input_container = resolver.get(val["hierarchy"]["id"])
             input_container_path = get_container_path(
-                fw, group_id, project_label, input_container
+                fw, group_id, project_label, input_container, resolver=resolver
             )
             input_files[key] = {
                 "container_path": input_container_path,
                 "location_name": val["location"]["name"],
             }
+            # so the script can fetch the input without searching for it
+            if val["hierarchy"].get("type") == "analysis":
+                input_files[key]["analysis_id"] = val["hierarchy"]["id"]
+            file_id = (val.get("object") or {}).get("file_id")
+            if file_id:
+                input_files[key]["file_id"] = file_id
+
+    return {
+        "job_id": job_id,
+        "job": job,
+        "gear": gear,
+        "api_url": api_url,
+        "destination_id": destination_id,
+        "destination_type": destination_type,
+        "destination": destination,
+        "group_id": group_id,
+        "project_label": project_label,
+        "container_path": container_path,
+        "input_files": input_files,
+        "script_name": script_name,
+    }
+
+
+def format_value(value, indent=0, column=None, trailer=0):
+    """Format a config, tags or inputs value as black would, without running it.
+
+    Args:
+        value: The value to format.
+        indent (int): Indentation of the line the value starts on.
+        column (int): Column the value starts at. Default to `indent`.
+        trailer (int): Number of characters following the value on its last line.
+
+    Returns:
+        str: The python source of the value.
+    """
+
+    if column is None:
+        column = indent
+
+    if isinstance(value, str):
+        source = repr(value)
+        # As black, double quotes unless they need more escapes than single ones
+        if source[0] == '"' or value.count('"') > value.count("'"):
+            return source
+        return '"' + source[1:-1].replace("\\'", "'").replace('"', '\\"') + '"'
+
+    if isinstance(value, dict):
+        keys = [format_value(k) + ": " for k in value]
+        values = list(value.values())
+        brackets = "{}"
+    elif isinstance(value, (list, tuple)):
+        keys = [""] * len(value)
+        values = list(value)
+        brackets = "[]"
+    else:
+        return repr(value)
+
+    items = [key + format_value(v) for key, v in zip(keys, values)]
+    one_line = brackets[0] + ", ".join(items) + brackets[1]
+    if not items or column + len(one_line) + trailer <= LINE_LENGTH:
+        return one_line
+
+    # A single item goes on its own line, several items get one line each
+    item_indent = indent + 4
+    if len(items) == 1:
+        body = keys[0] + format_value(
+            values[0], item_indent, item_indent + len(keys[0])
+        )
+    else:
+        body = f",\n{' ' * item_indent}".join(
+            key + format_value(v, item_indent, item_indent + len(key), trailer=1)
+            for key, v in zip(keys, values)
+        )
+        body += ","
+    return f"{brackets[0]}\n{' ' * item_indent}{body}\n{' ' * indent}{brackets[1]}"
 
-    lines = f"""#! /usr/bin/env python3
-'''Run {gear.gear.name} on {destination_type} "{destination.label}"
 
-    This script was created to run Job ID {job_id}
-    In project "{group_id}/{project_label}"
-    On Flywheel Instance {fw.get_config().site.api_url}
-'''
+def write_script(job_info, script_name=None):
+    """Write an executable python script re-running a job collected by collect_job().
 
-import os
-import argparse
-from datetime import datetime
+    Returns:
+        str: The name of the script.
+    """
 
+    job = job_info["job"]
+    gear = job_info["gear"]
+    script_name = script_name or job_info["script_name"]
 
-import flywheel
+    tags = list(job["tags"])
+    if "analysis" in tags:
+        tags.remove("analysis")  # that will be added automatically
 
+    if job.destination.type == "analysis":
+        run = RUN_ANALYSIS_TEMPLATE
+    else:
+        run = RUN_JOB_TEMPLATE
+
+    script = SCRIPT_TEMPLATE.substitute(
+        gear_name=gear.gear.name,
+        gear_version=gear.gear.version,
+        destination_type=job_info["destination_type"],
+        destination_label=job_info["destination"].label,
+        destination_id=job_info["destination_id"],
+        job_id=job_info["job_id"],
+        group_id=job_info["group_id"],
+        project_label=job_info["project_label"],
+        api_url=job_info["api_url"],
+        destination_path=format_value(job_info["container_path"]),
+        input_files=format_value(job_info["input_files"], column=len("input_files = ")),
+        config=format_value(job["config"]["config"], 4, len("    config = ")),
+        tags=format_value(tags, 4, len("    tags = ")),
+        run=run,
+    )
 
-input_files = {pprint.pformat(input_files)}
+    with open(script_name, "w") as sfp:
+        sfp.write(script)
 
-def main(fw):
+    st = os.stat(script_name)
+    os.chmod(script_name, st.st_mode | stat.S_IEXEC)
 
-    gear = fw.lookup("gears/{gear.gear.name}")
-    print("gear.gear.version in original job was = {gear.gear.version}")"""
-
-    sfp = open(script_name, "w")
-    for line in lines.split("\n"):
-        sfp.write(line + "\n")
-
-    sfp.write('    print(f"gear.gear.version now = {gear.gear.version}")\n')
-    sfp.write(f'    print("destination_id = {destination_id}")\n')
-    sfp.write(f'    print("destination type is: {destination_type}")\n')
-
-    sfp.write(f'    destination = fw.lookup("{container_path}")\n')
-
-    sfp.write("\n")
-    sfp.write("    inputs = dict()\n")
-    sfp.write("    for key, val in input_files.items():\n")
-    sfp.write("         if val['container_path'][:8] == 'analysis':\n")
-    sfp.write("             path = val['container_path'][9:]\n")
-    sfp.write("             parent_of_analysis = fw.lookup(path)\n")
-    sfp.write("             # find analysis that has the right file\n")
-    sfp.write("             analyses = parent_of_analysis.reload().analyses\n")
-    sfp.write("             for analysis in analyses:\n")
-    sfp.write("                 for file in analysis.files:\n")
-    sfp.write("                     if file.name == val['location_name']:\n")
-    sfp.write("                         container = analysis\n")
-    sfp.write("         else:\n")
-    sfp.write("             container = fw.lookup(val['container_path'])\n")
-    sfp.write("         inputs[key] = container.get_file(val['location_name'])\n")
-    sfp.write("\n")
-    sfp.write(f"    config = {pprint.pformat(job['config']['config'], indent=4)}\n")
-    sfp.write("\n")
-    tags = job["tags"]
-    if "analysis" in tags:
-        tags.remove("analysis") # that will be added automatically
-    sfp.write(f"    tags = {pprint.pformat(tags, indent=4)}\n")
-    sfp.write("\n")
+    return script_name
 
-    if job.destination.type == "analysis":
-        sfp.write("    now = datetime.now()\n")
-        sfp.write("    analysis_label = (\n")
-        sfp.write(
-            "        f'{gear.gear.name} {now.strftime(\"%m-%d-%Y %H:%M:%S\")} SDK launched'\n"
+
+def write_launcher(launcher_name, script_names):
+    """Write a script running the main() of each generated script with one client."""
+
+    script = LAUNCHER_TEMPLATE.substitute(
+        num_scripts=len(script_names),
+        scripts=format_value(script_names, column=len("scripts = ")),
+    )
+    with open(launcher_name, "w") as sfp:
+        sfp.write(script)
+
+    st = os.stat(launcher_name)
+    os.chmod(launcher_name, st.st_mode | stat.S_IEXEC)
+
+
+def format_scripts(script_names):
+    """Run black in-process, once over all the generated scripts.
+
+    The scripts are written already formatted, so this is optional.
+    """
+
+    try:
+        import black
+    except ImportError:
+        print("black is not installed, scripts are left as generated")
+        return
+
+    mode = black.Mode(line_length=LINE_LENGTH)
+    changed = 0
+    for script_name in script_names:
+        if black.format_file_in_place(
+            Path(script_name), fast=True, mode=mode, write_back=black.WriteBack.YES
+        ):
+            changed += 1
+    print(f"black reformatted {changed} of {len(script_names)} scripts")
+
+
+def sample_job_info(destination_type):
+    """Job info, as collected by collect_job(), of a made-up job.
+
+    Its config, tags and inputs are long enough to be split over several lines.
+    """
+
+    job = flywheel.Job(
+        gear_id="5f0c9b5e8a4c2b001e6d3a7f",
+        destination=flywheel.JobDestination(
+            type=destination_type, id="5f0c9b5e8a4c2b001e6d3a80"
+        ),
+        tags=["analysis", "copied-job", "it's quoted", 'say "hi"'],
+        config={
+            "config": {
+                "debug": False,
+                "n_threads": 4,
+                "threshold": 0.5,
+                "measures": [
+                    "fd",
+                    "dvars",
+                    "tsnr",
+                    "efc",
+                    "fber",
+                    "snr",
+                    "cjv",
+                    "cnr",
+                    "fwhm",
+                ],
+                "pipeline": {"steps": ["denoise", "register"], "template": None},
+            },
+            "inputs": {},
+        },
+    )
+    gear = flywheel.GearDoc(gear=flywheel.Gear(name="sample-gear", version="1.2.3"))
+    destination = flywheel.Acquisition(label="T1w MPRAGE")
+    container_path = "group/Project Label/Subject Label/Session Label/T1w MPRAGE"
+    return {
+        "job_id": "5f0c9b5e8a4c2b001e6d3a81",
+        "job": job,
+        "gear": gear,
+        "api_url": "https://example.flywheel.io/api",
+        "destination_id": "5f0c9b5e8a4c2b001e6d3a82",
+        "destination_type": "acquisition",
+        "destination": destination,
+        "group_id": "group",
+        "project_label": "Project Label",
+        "container_path": container_path,
+        "input_files": {
+            "nifti": {
+                "container_path": container_path,
+                "location_name": "T1w_MPRAGE.nii.gz",
+                "file_id": "5f0c9b5e8a4c2b001e6d3a83",
+            },
+            "mask": {
+                "container_path": container_path + "/previous-analysis",
+                "location_name": "mask.nii.gz",
+                "analysis_id": "5f0c9b5e8a4c2b001e6d3a84",
+            },
+        },
+        "script_name": "sample-gear_acquisition_T1w_MPRAGE.py",
+    }
+
+
+def check_format():
+    """Check that black leaves the scripts and launchers written unchanged.
+
+    Scripts re-running a sample job and analysis, and their launcher, are written
+    to a temporary directory, so that changes to the templates or to
+    format_value() that black would not agree with are caught.
+
+    Returns:
+        bool: True if black would leave all of them unchanged.
+    """
+
+    try:
+        import black
+    except ImportError:
+        print("black is not installed, the format can not be checked")
+        return False
+
+    mode = black.Mode(line_length=LINE_LENGTH)
+    with TemporaryDirectory() as tmp_dir:
+        script_names = [
+            write_script(
+                sample_job_info(destination_type),
+                os.path.join(tmp_dir, f"{destination_type}.py"),
+            )
+            for destination_type in ("acquisition", "analysis")
+        ]
+        launcher_name = os.path.join(tmp_dir, "launcher.py")
+        write_launcher(launcher_name, script_names)
+
+        unformatted = list()
+        for name in script_names + [launcher_name]:
+            source = Path(name).read_text()
+            if black.format_str(source, mode=mode) != source:
+                unformatted.append(os.path.basename(name))
+
+    if unformatted:
+        print(f"black would reformat: {', '.join(unformatted)}")
+        return False
+    print("black would leave the scripts and launcher unchanged")
+    return True
+
+
+def expand_launchers(script_names):
+    """Replace the launchers created by copy-job.py by the scripts they run."""
+
+    expanded = list()
+    for script_name in script_names:
+        try:
+            script = runpy.run_path(script_name)
+        except Exception:
+            script = dict()  # reported by check_script()
+        if "scripts" in script and "input_files" not in script:
+            here = os.path.dirname(os.path.abspath(script_name))
+            expanded.extend(
+                os.path.relpath(os.path.join(here, name)) for name in script["scripts"]
+            )
+        else:
+            expanded.append(os.path.relpath(script_name))
+    return list(dict.fromkeys(expanded))
+
+
+def describe_error(exc):
+    """Describe an error met while checking a script, in one line."""
+    if isinstance(exc, flywheel.ApiException):
+        return f"{exc.status} {exc.reason}"
+    return f"{type(exc).__name__}: {exc}"
+
+
+def check_script(fw, script_name):
+    """Look up the destination and inputs of a generated script, without running it.
+
+    Returns:
+        dict: Whether the script is ready to run, whether its destination was found,
+            its missing inputs, the errors met and the time spent on lookups.
+    """
+
+    report = {
+        "script": script_name,
+        "ready": False,
+        "destination": False,
+        "missing": list(),
+        "errors": list(),
+        "latency": 0.0,
+    }
+    start = time.perf_counter()
+
+    try:
+        script = runpy.run_path(script_name)
+    except Exception as exc:
+        report["errors"].append(f"could not load the script: {exc}")
+        return report
+    if "destination_path" not in script or "get_input" not in script:
+        report["errors"].append("not created by this version of copy-job.py")
+        return report
+
+    try:
+        fw.lookup(script["destination_path"])
+        report["destination"] = True
+    except Exception as exc:
+        report["errors"].append(
+            f"destination {script['destination_path']}: {describe_error(exc)}"
         )
-        sfp.write("    )\n")
-        sfp.write("    print(f'analysis_label = {analysis_label}')\n")
 
-        lines = f"""
-    analysis_id = gear.run(
-        analysis_label=analysis_label,
-        tags=tags,
-        config=config,
-        inputs=inputs,
-        destination=destination,
-    )"""
-        for line in lines.split("\n"):
-            sfp.write(line + "\n")
-        sfp.write("    print(f'analysis_id = {analysis_id}')\n")
-        sfp.write("    return analysis_id\n")
+    analyses_by_file = dict()
+    for key, val in script.get("input_files", dict()).items():
+        try:
+            found = script["get_input"](fw, val, analyses_by_file) is not None
+        except Exception as exc:
+            found = False
+            report["errors"].append(f"input {key}: {describe_error(exc)}")
+        if not found:
+            report["missing"].append(key)
 
-    else:
-        lines = f"""
-    job_id = gear.run(
-        tags=tags,
-        config=config,
-        inputs=inputs,
-        destination=destination
-    )"""
-        for line in lines.split("\n"):
-            sfp.write(line + "\n")
-        sfp.write("    print(f'job_id = {job_id}')\n")
-        sfp.write("    return job_id\n")
+    report["latency"] = time.perf_counter() - start
+    report["ready"] = report["destination"] and not report["missing"]
+    return report
 
-    lines = f"""
-if __name__ == '__main__':
 
-    parser = argparse.ArgumentParser(description=__doc__)
-    args = parser.parse_args()
+def preflight(script_names, workers=BATCH_WORKERS):
+    """Check generated scripts (or launchers) concurrently, without running any gear.
 
-    fw = flywheel.Client('')
-    print(fw.get_config().site.api_url)
+    Returns:
+        list: The report of each script, as returned by check_script().
+    """
 
-    analysis_id = main(fw)"""
+    start = time.perf_counter()
 
-    for line in lines.split("\n"):
-        sfp.write(line + "\n")
+    fw = flywheel.Client("")
+    print("Flywheel Instance", fw.get_config().site.api_url)
 
-    sfp.write("\n")
-    sfp.write("    os.sys.exit(0)\n")
+    def check(script_name):
+        try:
+            return check_script(fw, script_name)
+        except Exception as exc:
+            # One broken script does not abort the checks of the others
+            return {
+                "script": script_name,
+                "ready": False,
+                "destination": False,
+                "missing": list(),
+                "errors": [f"could not check the script: {describe_error(exc)}"],
+                "latency": 0.0,
+            }
 
-    sfp.close()
+    script_names = expand_launchers(script_names)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        reports = list(executor.map(check, script_names))
+
+    for report in reports:
+        status = "ready" if report["ready"] else "NOT READY"
+        print(f"{status:9}  {report['script']} ({report['latency']:.2f} s)")
+        if report["missing"]:
+            print(f"    missing inputs: {', '.join(report['missing'])}")
+        for error in report["errors"]:
+            print(f"    {error}")
+
+    ready = sum(report["ready"] for report in reports)
+    latencies = sorted(report["latency"] for report in reports) or [0.0]
+    print(
+        f"\n{ready} of {len(reports)} scripts ready to run\n"
+        f"lookups per script: median {latencies[len(latencies) // 2]:.2f} s, "
+        f"max {latencies[-1]:.2f} s\n"
+        f"total: {time.perf_counter() - start:.2f} s"
+    )
+    return reports
 
-    os.system(f"black {script_name}")
 
-    st = os.stat(script_name)
-    os.chmod(script_name, st.st_mode | stat.S_IEXEC)
+def main(job_id, analysis=False, black=False):
+
+    fw = flywheel.Client("")
+    api_url = fw.get_config().site.api_url
+    print("Flywheel Instance", api_url)
+
+    job_info = collect_job(fw, job_id, api_url, analysis=analysis)
+    print(f"Creating script: {job_info['script_name']} ...\n")
+    script_name = write_script(job_info)
+
+    if black:
+        format_scripts([script_name])
+
+
+def main_batch(
+    job_ids,
+    analysis=False,
+    query=None,
+    workers=BATCH_WORKERS,
+    launcher=None,
+    black=False,
+):
+    """Create scripts re-running many jobs, fetching them concurrently."""
+
+    start = time.perf_counter()
+
+    fw = flywheel.Client("")
+    api_url = fw.get_config().site.api_url
+    print("Flywheel Instance", api_url)
+
+    job_ids = list(job_ids)
+    if query:
+        job_ids.extend(job.id for job in fw.jobs.iter_find(query))
+        print(f"Found {len(job_ids)} jobs matching '{query}'")
+    job_ids = list(dict.fromkeys(job_ids))
+
+    resolver = ContainerResolver(fw)
+    collected = dict()
+    failed = dict()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            job_id: executor.submit(
+                collect_job, fw, job_id, api_url, analysis, resolver, False
+            )
+            for job_id in job_ids
+        }
+        for job_id, future in futures.items():
+            try:
+                collected[job_id] = future.result()
+            except Exception as exc:
+                print(f"Error: could not collect job {job_id}: {exc}")
+                failed[job_id] = exc
+    fetch_time = time.perf_counter() - start
+
+    script_names = list()
+    for job_id in job_ids:
+        if job_id not in collected:
+            continue
+        job_info = collected[job_id]
+        script_name = job_info["script_name"]
+        # jobs re-run on the same destination would otherwise overwrite each other
+        if script_name in script_names:
+            root, ext = os.path.splitext(script_name)
+            script_name = f"{root}_{job_info['job_id']}{ext}"
+        print(f"Creating script: {script_name}")
+        script_names.append(write_script(job_info, script_name))
+
+    if launcher:
+        print(f"Creating launcher: {launcher}")
+        write_launcher(launcher, script_names)
+
+    format_start = time.perf_counter()
+    if black and script_names:
+        format_scripts(script_names)
+    format_time = time.perf_counter() - format_start
+
+    print(
+        f"\n{len(script_names)} scripts created for {len(job_ids)} jobs "
+        f"({len(failed)} failed)\n"
+        f"{resolver.api_calls} gears and containers fetched\n"
+        f"fetch: {fetch_time:.2f} s, "
+        f"format: {format_time:.2f} s, "
+        f"total: {time.perf_counter() - start:.2f} s"
+    )
 
 
 if __name__ == "__main__":
@@ -247,17 +840,79 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
     )
-    parser.add_argument("job_id", help="Flywheel job ID")
+    parser.add_argument("job_ids", nargs="*", help="Flywheel job ID(s)")
     parser.add_argument(
         "-a",
         "--analysis",
         action="store_true",
-        help="ID provided is for the analysis (job destination)",
+        help="IDs provided are for the analyses (job destinations)",
+    )
+    parser.add_argument(
+        "-f", "--file", help="File with more job (or analysis) IDs, one per line"
+    )
+    parser.add_argument(
+        "-q",
+        "--query",
+        help="Filter selecting more jobs, e.g. 'gear_info.name=mriqc,state=failed'",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=BATCH_WORKERS,
+        help=f"Number of jobs (or scripts) handled at once (default {BATCH_WORKERS})",
+    )
+    parser.add_argument(
+        "-l", "--launcher", help="Also create a script running all the copied jobs"
+    )
+    parser.add_argument(
+        "-b",
+        "--black",
+        action="store_true",
+        help="Also run black on the scripts (they are created formatted)",
+    )
+    parser.add_argument(
+        "-p",
+        "--preflight",
+        action="store_true",
+        help="IDs provided are generated scripts (or launchers) to check without "
+        "running them: their destination and inputs are looked up",
+    )
+    parser.add_argument(
+        "--check-format",
+        action="store_true",
+        help="Check that black leaves the scripts written for sample jobs unchanged",
     )
     parser.add_argument("-v", "--verbose", action="count", default=0)
 
     args = parser.parse_args()
 
-    main(args.job_id)
+    if args.check_format:
+        os.sys.exit(0 if check_format() else 1)
+
+    job_ids = list(args.job_ids)
+    if args.file:
+        with open(args.file) as fp:
+            job_ids.extend(line.strip() for line in fp if line.strip())
+
+    if args.preflight:
+        if not job_ids:
+            parser.error("provide the scripts to check")
+        reports = preflight(job_ids, workers=args.workers)
+        os.sys.exit(0 if all(report["ready"] for report in reports) else 1)
+
+    if len(job_ids) == 1 and not (args.query or args.launcher):
+        main(job_ids[0], analysis=args.analysis, black=args.black)
+    elif job_ids or args.query:
+        main_batch(
+            job_ids,
+            analysis=args.analysis,
+            query=args.query,
+            workers=args.workers,
+            launcher=args.launcher,
+            black=args.black,
+        )
+    else:
+        parser.error("provide at least one job ID, a --file or a --query")
 
     os.sys.exit(0)
@@ -4,12 +4,102 @@ Flywheel.
 """
 import logging
 import os
+import random
+import tempfile
+import threading
 import time
+import zipfile
 
 import flywheel
 
 log = logging.getLogger(__name__)
 
+# Max time (in seconds) to wait for an uploaded file to be available
+UPLOAD_CONFIRM_TIMEOUT = 60
+# First and max delays (in seconds) between two reloads of the Acquisition
+UPLOAD_CONFIRM_DELAY = 0.1
+UPLOAD_CONFIRM_MAX_DELAY = 5
+
+# Number of containers with pending metadata updates that triggers a flush
+METADATA_MAX_PENDING = 500
+
+# Size (in bytes) above which a zip archive built for upload spills to a temp file
+ZIP_SPOOL_THRESHOLD = 64 * 1024 * 1024
+
+
+class ProjectHierarchyIndex:
+    """
+    In-memory index of the Subjects, Sessions and Acquisitions of a Project.
+
+    The whole hierarchy is loaded with one paginated query per container level, so
+    the `find_or_create_*` functions can resolve labels from memory instead of
+    issuing a `find_first` query per row. Containers created through those functions
+    are added to the index as they are created.
+
+    Args:
+        fw_client (flywheel.Client): An active client to a Flywheel instance.
+        project (flywheel.Project): The Project to index.
+        load (bool, optional): Flag to load the hierarchy on creation.
+            Defaults to True.
+    """
+
+    def __init__(self, fw_client, project, load=True):
+        self.fw_client = fw_client
+        self.project = project
+        self._subjects = {}
+        self._sessions = {}
+        self._acquisitions = {}
+        if load:
+            self.load()
+
+    def load(self):
+        """(Re)load the labels and ids of the whole Project hierarchy."""
+        self._subjects.clear()
+        self._sessions.clear()
+        self._acquisitions.clear()
+
+        for subject in self.project.subjects.iter():
+            self._subjects.setdefault(subject.label, subject)
+        for session in self.project.sessions.iter():
+            self._sessions.setdefault((session.parents.subject, session.label), session)
+        for acq in self.fw_client.acquisitions.iter_find(
+            f"parents.project={self.project.id}"
+        ):
+            self._acquisitions.setdefault((acq.parents.session, acq.label), acq)
+
+        log.info(
+            "Indexed %d subjects, %d sessions and %d acquisitions of project %s.",
+            len(self._subjects),
+            len(self._sessions),
+            len(self._acquisitions),
+            self.project.label,
+        )
+
+    def get_subject(self, label):
+        """Return the Subject with "label", or None if it is not indexed."""
+        return self._subjects.get(label)
+
+    def get_session(self, subject, label):
+        """Return the Session with "label" under "subject", or None."""
+        return self._sessions.get((subject.id, label))
+
+    def get_acquisition(self, session, label):
+        """Return the Acquisition with "label" under "session", or None."""
+        return self._acquisitions.get((session.id, label))
+
+    def add_subject(self, subject):
+        """Add or replace "subject" in the index."""
+        self._subjects[subject.label] = subject
+
+    def add_session(self, subject, session):
+        """Add or replace "session" under "subject" in the index."""
+        self._sessions[(subject.id, session.label)] = session
+
+    def add_acquisition(self, session, acq):
+        """Add or replace "acq" under "session" in the index."""
+        self._acquisitions[(session.id, acq.label)] = acq
+
+
 
 def find_or_create_group(fw_client, group_id, label):
     """
@@ -81,7 +171,9 @@ def find_or_create_project(label, group, update=True, **kwargs):
     return project
 
 
-def find_or_create_subject(label, project, update=True, **kwargs):
+def find_or_create_subject(
+    label, project, update=True, index=None, writer=None, **kwargs
+):
     """
     Find or create a Subject with "label" under "project".
 
@@ -93,6 +185,10 @@ def find_or_create_subject(label, project, update=True, **kwargs):
         project (flywheel.Project): The project object to create this Subject under.
         update (bool, optional): Flag to update metadata of new or existing Subject.
             Defaults to True.
+        index (ProjectHierarchyIndex, optional): Index of the Project to resolve the
+            Subject from, in place of a query. Defaults to None.
+        writer (MetadataWriteBuffer, optional): Buffer to defer the metadata update
+            to. Defaults to None, to update right away.
         kwargs (dict): Any key/value properties of the Subject you would like to update.
             Included `info` key is handled separately.
     Returns:
@@ -100,32 +196,36 @@ def find_or_create_subject(label, project, update=True, **kwargs):
     """
     if not label:
         return None
-    subject = project.subjects.find_first(f"label={label}")
+    if index is not None:
+        subject = index.get_subject(label)
+    else:
+        subject = project.subjects.find_first(f"label={label}")
 
     if not subject:
         log.info(f'Subject with label "{label}" not found, creating.')
         subject = project.add_subject(code=label, label=label)
+        if index is not None:
+            index.add_subject(subject)
     else:
         log.info(f'Subject with label "{label}" found.')
 
-    if update and kwargs:
-        subject.update(**kwargs)
-
     if subject:
-        if update and kwargs:
-            # Check for info, separate update process
-            if "info" in kwargs:
-                info = kwargs.pop("info")
-                subject.update_info(info)
-            # Check for empty dictionary
-            if kwargs:
-                subject.update(**kwargs)
-        subject = subject.reload()
+        updated = bool(update and kwargs)
+        if updated:
+            update_metadata(subject, writer=writer, **kwargs)
+        # An indexed Subject is only out of date once its metadata is updated, and a
+        # deferred update is not visible before the writer is flushed
+        if writer is None and (index is None or updated):
+            subject = subject.reload()
+            if index is not None:
+                index.add_subject(subject)
 
     return subject
 
 
-def find_or_create_session(label, subject, update=True, **kwargs):
+def find_or_create_session(
+    label, subject, update=True, index=None, writer=None, **kwargs
+):
     """
     Find or create a Session with "label" under "subject".
 
@@ -136,6 +236,10 @@ def find_or_create_session(label, subject, update=True, **kwargs):
         subject (flywheel.Subject): The Flywheel Subject to create the Session under.
         update (bool, optional): Flag to update metadata of new or existing Session.
             Defaults to True.
+        index (ProjectHierarchyIndex, optional): Index of the Project to resolve the
+            Session from, in place of a query. Defaults to None.
+        writer (MetadataWriteBuffer, optional): Buffer to defer the metadata update
+            to. Defaults to None, to update right away.
         kwargs (dict): Any key/value properties of the Session you would like to update.
             Included `info` key is handled separately.
     Returns:
@@ -143,30 +247,35 @@ def find_or_create_session(label, subject, update=True, **kwargs):
     """
     if not label:
         return None
-    session = subject.sessions.find_first(f"label={label}")
+    if index is not None:
+        session = index.get_session(subject, label)
+    else:
+        session = subject.sessions.find_first(f"label={label}")
 
     if not session:
         log.info(f'Session with label "{label}" not found, creating.')
         session = subject.add_session(label=label)
+        if index is not None:
+            index.add_session(subject, session)
     else:
         log.info(f'Session with label "{label}" found.')
 
     if session:
-        if update and kwargs:
-            # Check for info, separate update process
-            if "info" in kwargs:
-                info = kwargs.pop("info")
-                session.update_info(info)
-            # Check for empty dictionary
-            if kwargs:
-                session.update(**kwargs)
+        updated = bool(update and kwargs)
+        if updated:
+            update_metadata(session, writer=writer, **kwargs)
 
-        session = session.reload()
+        if writer is None and (index is None or updated):
+            session = session.reload()
+            if index is not None:
+                index.add_session(subject, session)
 
     return session
 
 
-def find_or_create_acquisition(label, session, update=True, **kwargs):
+def find_or_create_acquisition(
+    label, session, update=True, index=None, writer=None, **kwargs
+):
     """
     Find or create a Acquisition with "label" under "Session".
 
@@ -177,6 +286,10 @@ def find_or_create_acquisition(label, session, update=True, **kwargs):
         session (flywheel.Session): Session to find or create Acquisition under.
         update (bool, optional): Flag to update metadata of new or existing Acquisition.
             Defaults to True.
+        index (ProjectHierarchyIndex, optional): Index of the Project to resolve the
+            Acquisition from, in place of a query. Defaults to None.
+        writer (MetadataWriteBuffer, optional): Buffer to defer the metadata update
+            to. Defaults to None, to update right away.
         kwargs (dict): Any key/value properties of the Acquisition subject you would
             like to update. Included `info` key is handled separately.
 
@@ -186,61 +299,401 @@ def find_or_create_acquisition(label, session, update=True, **kwargs):
     if not label:
         return None
 
-    acq = session.acquisitions.find_first(f"label={label}")
+    if index is not None:
+        acq = index.get_acquisition(session, label)
+    else:
+        acq = session.acquisitions.find_first(f"label={label}")
 
     if not acq:
         log.info(f'Acquisition with label "{label}" not found, creating.')
         acq = session.add_acquisition(label=label)
+        if index is not None:
+            index.add_acquisition(session, acq)
 
     else:
         log.info(f'Acquisition with label "{label}" found.')
 
     if acq:
-        if update and kwargs:
-            # Check for info, separate update process
-            if "info" in kwargs:
-                info = kwargs.pop("info")
-                acq.update_info(info)
-            # Check for empty dictionary
-            if kwargs:
-                acq.update(**kwargs)
+        updated = bool(update and kwargs)
+        if updated:
+            update_metadata(acq, writer=writer, **kwargs)
 
-        acq = acq.reload()
+        if writer is None and (index is None or updated):
+            acq = acq.reload()
+            if index is not None:
+                index.add_acquisition(session, acq)
 
     return acq
 
 
-def upload_file_to_acquisition(acquisition, fp, update=True, **kwargs):
+def upload_file_to_acquisition(
+    acquisition, fp, update=True, timeout=UPLOAD_CONFIRM_TIMEOUT, writer=None, **kwargs
+):
     """Upload file to Acquisition container and update info if `update=True`.
 
     Args:
         acquisition (flywheel.Acquisition): A Flywheel Acquisition
-        fp (Path-like): Path to file to upload
+        fp (Path-like or flywheel.FileSpec): Path to file to upload, or file spec of
+            in-memory contents to upload.
         update (bool): If true, update file metadata with key/value passed as kwargs.
+        timeout (float): Max time (in seconds) to wait for the uploaded file to be
+            available. Defaults to UPLOAD_CONFIRM_TIMEOUT.
+        writer (MetadataWriteBuffer, optional): Buffer to defer the metadata update
+            to. Defaults to None, to update right away.
         kwargs (dict): Any key/value properties of the Acquisition file you would like
             to update. Included `info` key is handled separately.
+
+    Returns:
+        flywheel.FileEntry: The uploaded file, or None if it already existed.
     """
-    basename = os.path.basename(fp)
-    if not os.path.isfile(fp):
-        raise ValueError(f"{fp} is not file.")
+    entries = upload_files_to_acquisition(
+        acquisition, [fp], update=update, timeout=timeout, writer=writer, **kwargs
+    )
+    return entries[0]
 
-    if acquisition.get_file(basename):
-        log.info(f"File {basename} already exists in container. Skipping.")
-        return
-    else:
-        log.info(f"Uploading {fp} to acquisition {acquisition.id}")
-        acquisition.upload_file(fp)
-        # to make sure the file is available before performing an update
-        while not acquisition.get_file(basename):
-            acquisition = acquisition.reload()
-            time.sleep(1)
+
+def upload_files_to_acquisition(
+    acquisition, fps, update=True, timeout=UPLOAD_CONFIRM_TIMEOUT, writer=None, **kwargs
+):
+    """Upload files to Acquisition container and update info if `update=True`.
+
+    Files are all uploaded before waiting for them to be available, so one reload
+    of the Acquisition confirms all the pending uploads.
+
+    Args:
+        acquisition (flywheel.Acquisition): A Flywheel Acquisition
+        fps (list): Paths to files, or file specs of in-memory contents, to upload
+        update (bool): If true, update file metadata with key/value passed as kwargs.
+        timeout (float): Max time (in seconds) to wait for the uploaded files to be
+            available. Defaults to UPLOAD_CONFIRM_TIMEOUT.
+        writer (MetadataWriteBuffer, optional): Buffer to defer the metadata updates
+            to. Defaults to None, to update right away.
+        kwargs (dict): Any key/value properties of the Acquisition files you would
+            like to update. Included `info` key is handled separately.
+
+    Returns:
+        list: The uploaded file of each path, or None if it already existed.
+    """
+    basenames = []
+    for fp in fps:
+        if isinstance(fp, flywheel.FileSpec):
+            basenames.append(fp.name)
+            continue
+        if not os.path.isfile(fp):
+            raise ValueError(f"{fp} is not file.")
+        basenames.append(os.path.basename(fp))
+
+    entries = {}
+    pending = []
+    for fp, basename in zip(fps, basenames):
+        if acquisition.get_file(basename):
+            log.info(f"File {basename} already exists in container. Skipping.")
+            continue
+        log.info(f"Uploading {basename} to acquisition {acquisition.id}")
+        start = time.perf_counter()
+        response = acquisition.upload_file(fp)
+        log.debug("Uploaded %s in %.3f s", basename, time.perf_counter() - start)
+        entry = _file_from_upload_response(response, basename)
+        if entry:
+            entries[basename] = entry
+        else:
+            pending.append(basename)
+
+    if pending:
+        # to make sure the files are available before performing an update
+        entries.update(confirm_uploads(acquisition, pending, timeout=timeout))
 
     if update and kwargs:
-        f = acquisition.get_file(basename)
-        # Check for info, separate process
-        if "info" in kwargs:
-            info = kwargs.pop("info")
-            f.update_info(info)
-        # Check for empty dictionary
-        if kwargs:
-            f.update(**kwargs)
+        for entry in entries.values():
+            update_metadata(entry, writer=writer, **kwargs)
+
+    return [entries.get(basename) for basename in basenames]
+
+
+def upload_zip_to_acquisition(
+    acquisition,
+    name,
+    fps,
+    arcnames=None,
+    spool_threshold=ZIP_SPOOL_THRESHOLD,
+    update=True,
+    timeout=UPLOAD_CONFIRM_TIMEOUT,
+    writer=None,
+    **kwargs,
+):
+    """Zip files and upload the archive to Acquisition container without a temp file.
+
+    The archive is built in memory and only spills to an anonymous temporary file,
+    removed even if the process crashes, when larger than `spool_threshold`.
+
+    Args:
+        acquisition (flywheel.Acquisition): A Flywheel Acquisition
+        name (str): Name of the zip archive in the Acquisition.
+        fps (list): Paths to files to zip.
+        arcnames (list, optional): Name of each file in the archive. Defaults to None,
+            for the file names.
+        spool_threshold (int, optional): Size (in bytes) above which the archive
+            spills to disk. Defaults to ZIP_SPOOL_THRESHOLD.
+        update (bool): If true, update file metadata with key/value passed as kwargs.
+        timeout (float): Max time (in seconds) to wait for the uploaded file to be
+            available. Defaults to UPLOAD_CONFIRM_TIMEOUT.
+        writer (MetadataWriteBuffer, optional): Buffer to defer the metadata update
+            to. Defaults to None, to update right away.
+        kwargs (dict): Any key/value properties of the Acquisition file you would like
+            to update. Included `info` key is handled separately.
+
+    Returns:
+        flywheel.FileEntry: The uploaded file, or None if it already existed.
+    """
+    if acquisition.get_file(name):
+        log.info(f"File {name} already exists in container. Skipping.")
+        return None
+
+    with zip_files(fps, arcnames=arcnames, spool_threshold=spool_threshold) as archive:
+        file_spec = flywheel.FileSpec(name, archive, "application/zip")
+        return upload_file_to_acquisition(
+            acquisition, file_spec, update=update, timeout=timeout, writer=writer, **kwargs
+        )
+
+
+def zip_files(fps, arcnames=None, spool_threshold=ZIP_SPOOL_THRESHOLD):
+    """Zip files into a buffer held in memory up to `spool_threshold` bytes.
+
+    Args:
+        fps (list): Paths to files to zip.
+        arcnames (list, optional): Name of each file in the archive. Defaults to None,
+            for the file names.
+        spool_threshold (int, optional): Size (in bytes) above which the buffer
+            spills to an anonymous temporary file. Defaults to ZIP_SPOOL_THRESHOLD.
+
+    Returns:
+        tempfile.SpooledTemporaryFile: The zip archive, positioned at its start.
+    """
+    if arcnames is None:
+        arcnames = [os.path.basename(fp) for fp in fps]
+    archive = tempfile.SpooledTemporaryFile(max_size=spool_threshold)
+    with zipfile.ZipFile(archive, "w") as zf:
+        for fp, arcname in zip(fps, arcnames):
+            zf.write(fp, arcname=arcname)
+    archive.seek(0)
+    return archive
+
+
+def confirm_uploads(acquisition, basenames, timeout=UPLOAD_CONFIRM_TIMEOUT):
+    """Wait for uploaded files to be available on an Acquisition.
+
+    The Acquisition is reloaded with exponential backoff and jitter until all the
+    files are found, each reload confirming all the files still pending.
+
+    Args:
+        acquisition (flywheel.Acquisition): A Flywheel Acquisition
+        basenames (list): Names of the uploaded files.
+        timeout (float): Max time (in seconds) to wait. Defaults to
+            UPLOAD_CONFIRM_TIMEOUT.
+
+    Returns:
+        dict: The uploaded files, keyed by name.
+
+    Raises:
+        TimeoutError: If some files are still not available after `timeout`.
+    """
+    start = time.monotonic()
+    pending = set(basenames)
+    entries = {}
+    delay = UPLOAD_CONFIRM_DELAY
+    reloads = 0
+    while pending:
+        remaining = start + timeout - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(
+                f"Files {sorted(pending)} not available on acquisition "
+                f"{acquisition.id} after {timeout} s."
+            )
+        time.sleep(min(delay / 2 + random.uniform(0, delay / 2), remaining))
+        delay = min(delay * 2, UPLOAD_CONFIRM_MAX_DELAY)
+
+        acquisition = acquisition.reload()
+        reloads += 1
+        for basename in list(pending):
+            entry = acquisition.get_file(basename)
+            if entry:
+                entries[basename] = entry
+                pending.discard(basename)
+
+    log.debug(
+        "Confirmed %d uploads with %d reloads in %.3f s",
+        len(entries),
+        reloads,
+        time.monotonic() - start,
+    )
+    return entries
+
+
+def _file_from_upload_response(response, basename):
+    """Return the file entry named "basename" of an upload response, if any."""
+    if not isinstance(response, list):
+        return None
+    for entry in response:
+        # Only an entry bound to its parent container can be updated
+        if getattr(entry, "name", None) == basename and hasattr(entry, "update_info"):
+            return entry
+    return None
+
+
+def update_metadata(container, writer=None, **kwargs):
+    """Update the metadata of a container or file with key/value passed as kwargs.
+
+    Args:
+        container (flywheel.Container or flywheel.FileEntry): The container or file
+            to update.
+        writer (MetadataWriteBuffer, optional): Buffer to defer the update to.
+            Defaults to None, to update right away.
+        kwargs (dict): Any key/value properties you would like to update.
+            Included `info` key is handled separately.
+    """
+    if writer is not None:
+        writer.update(container, **kwargs)
+        return
+    # Check for info, separate process
+    if "info" in kwargs:
+        info = kwargs.pop("info")
+        container.update_info(info)
+    # Check for empty dictionary
+    if kwargs:
+        container.update(**kwargs)
+
+
+class MetadataWriteBuffer:
+    """
+    Coalesce the metadata updates of containers and files during an import.
+
+    Pending field and info changes are merged per container, later values winning,
+    and each container is written once per flush: at most one `update_info` and one
+    `update` request. The buffer is flushed when it holds `max_pending` containers,
+    when `flush` is called, and on exit when used as a context manager.
+
+    Args:
+        max_pending (int, optional): Number of pending containers that triggers a
+            flush. Defaults to METADATA_MAX_PENDING.
+        on_flush (callable, optional): Called with the markers (see `mark`) of each
+            flush once their updates are written. Defaults to None.
+    """
+
+    def __init__(self, max_pending=None, on_flush=None):
+        self.max_pending = max_pending or METADATA_MAX_PENDING
+        self.on_flush = on_flush
+        self.requests = 0
+        self.errors = 0
+        self._pending = {}
+        self._markers = []
+        # Keys of the containers being written by the current flush
+        self._writing = set()
+        self._lock = threading.Lock()
+        # Flushes are written one at a time so older values never overwrite newer ones
+        self._flush_lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.flush()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def update(self, container, **kwargs):
+        """Queue key/value updates of "container". Included `info` key is merged in
+        the container info."""
+        key = _container_key(container)
+        with self._lock:
+            if key not in self._pending:
+                self._pending[key] = (container, {}, {})
+            _, fields, info = self._pending[key]
+            info.update(kwargs.pop("info", None) or {})
+            fields.update(kwargs)
+            full = len(self._pending) >= self.max_pending
+        if full:
+            self.flush()
+
+    def mark(self, marker, *containers):
+        """Queue "marker", returned by the flush writing the updates of "containers"
+        queued so far (of all the containers if none are given)."""
+        with self._lock:
+            queued = self._pending.keys() | self._writing
+            if containers:
+                keys = {_container_key(container) for container in containers}
+                keys &= queued
+            else:
+                keys = set(queued)
+            self._markers.append((marker, keys))
+
+    def flush(self):
+        """
+        Write all the pending updates.
+
+        Each container is written on its own. The updates of the containers failing
+        to be written are logged and queued again for the next flush, with the
+        markers waiting for them.
+
+        Returns:
+            list: The markers queued since the previous flush whose updates were
+                written.
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+                markers, self._markers = self._markers, []
+                self._writing = set(pending)
+
+            failed = {}
+            for key, (container, fields, info) in pending.items():
+                try:
+                    self._write(container, fields, info)
+                except Exception:
+                    log.exception(
+                        "Failed to write the metadata of %s.",
+                        getattr(container, "id", None) or container,
+                    )
+                    failed[key] = (container, fields, info)
+
+            done = []
+            with self._lock:
+                self._writing = set()
+                for key, (container, fields, info) in failed.items():
+                    # Updates queued during the flush are newer
+                    if key in self._pending:
+                        _, new_fields, new_info = self._pending[key]
+                        fields.update(new_fields)
+                        info.update(new_info)
+                    self._pending[key] = (container, fields, info)
+                waiting = []
+                for marker, keys in markers:
+                    if keys & failed.keys():
+                        waiting.append((marker, keys & failed.keys()))
+                    else:
+                        done.append(marker)
+                self._markers[:0] = waiting
+                self.errors += len(failed)
+
+            if pending:
+                log.debug(
+                    "Flushed metadata of %d containers, %d failed.",
+                    len(pending),
+                    len(failed),
+                )
+            if self.on_flush:
+                self.on_flush(done)
+        return done
+
+    def _write(self, container, fields, info):
+        # `update(info=...)` would replace the whole info, `update_info` merges it
+        if info:
+            container.update_info(info)
+            self.requests += 1
+        if fields:
+            container.update(**fields)
+            self.requests += 1
+
+
+def _container_key(container):
+    return getattr(container, "id", None) or id(container)
@@ -3,14 +3,29 @@
 
     This may be expanded as the need arises.
 """
-import copy
 import datetime
 import logging
 
 import numpy as np
+import pandas as pd
 
 log = logging.getLogger(__name__)
 
+# Length of each time span unit, in days
+TIME_SPAN_DAYS = {
+    "Y": 365.25,
+    "M": 30,
+    "W": 7,
+    "D": 1,
+}
+
+SECONDS_PER_DAY = 24 * 60 * 60
+
+SEX_STRINGS = {"M": "male", "F": "female"}
+
+# Number of dataframe rows cleaned at once by `iter_cleaned_records`
+CLEANUP_CHUNK_SIZE = 10000
+
 
 def convert_time_to_seconds(time_span, scale):
     """
@@ -26,15 +41,9 @@ def convert_time_to_seconds(time_span, scale):
         int: Total seconds in time_span.
     """
 
-    conversion = {
-        "Y": 365.25,
-        "M": 30,
-        "W": 7,
-        "D": 1,
-    }
     try:
         seconds = datetime.timedelta(
-            int(time_span) * conversion.get(scale)
+            int(time_span) * TIME_SPAN_DAYS.get(scale)
         ).total_seconds()
     except ValueError:
         log.warning("Error, returning 0.")
@@ -81,6 +90,80 @@ def create_session_label(offset, default_session_label):
     return label
 
 
+def convert_times_to_seconds(time_spans, scale):
+    """
+    Vectorized `convert_time_to_seconds` over a whole column.
+
+    As with `int`, numbers are truncated and strings must be whole numbers. Any other
+    value converts to 0 seconds.
+
+    Args:
+        time_spans (pandas.Series or array-like): Lengths of time specified by units
+            "scale".
+        scale (str): The units of the lengths of time specified in "time_spans".
+            Valid Entries: 'Y', 'M', 'W', 'D'
+    Returns:
+        pandas.Series: Total seconds in each time span, as floats.
+    """
+    time_spans = pd.Series(time_spans)
+    if pd.api.types.is_numeric_dtype(time_spans):
+        spans = time_spans.astype("float64")
+    else:
+        # Strings that `int` would reject (e.g. "1.5") are set to NaN. The column
+        # may hold numbers as well (or only), which are matched as "0".
+        is_str = time_spans.map(lambda value: isinstance(value, str)).astype(bool)
+        strings = time_spans.where(is_str, "0").astype(str)
+        rejected = ~strings.str.fullmatch(r"\s*[+-]?\d+\s*")
+        spans = pd.to_numeric(time_spans.mask(rejected), errors="coerce").astype(
+            "float64"
+        )
+
+    invalid = ~np.isfinite(spans)
+    if invalid.any():
+        log.warning("Error for %d values, returning 0.", invalid.sum())
+    days = np.trunc(spans.where(~invalid, 0)) * TIME_SPAN_DAYS[scale]
+    # Rounded to microseconds, as `datetime.timedelta`
+    return (days * SECONDS_PER_DAY).round(6)
+
+
+def format_sex_strings(sex_strs):
+    """
+    Vectorized `format_sex_string` over a whole column.
+
+    Args:
+        sex_strs (pandas.Series or array-like): Strings consisting of 'M', 'F', '',
+            or None.
+
+    Returns:
+        pandas.Series: 'male', 'female', or '' for each string.
+    """
+    return pd.Series(sex_strs).map(SEX_STRINGS).fillna("").astype(object)
+
+
+def create_session_labels(offsets, default_session_label):
+    """
+    Vectorized `create_session_label` over a whole column.
+
+    Args:
+        offsets (pandas.Series or array-like): Number of days since the start of
+            symptoms or hospitalization. See SCHEMA.md.
+        default_session_label (str): Label of Sessions with no (or a 0) offset.
+
+    Returns:
+        pandas.Series: Label of each Session.
+    """
+    offsets = pd.to_numeric(pd.Series(offsets), errors="coerce")
+    valid = np.isfinite(offsets) & (offsets != 0)
+    days = np.trunc(offsets.where(valid, 0)).astype("int64")
+    # Offsets repeat a lot, so only format each distinct one
+    codes, unique_days = pd.factorize(days)
+    unique_labels = np.array(
+        [f"offset_{str(day).zfill(3)}" for day in unique_days], dtype=object
+    )
+    labels = pd.Series(unique_labels[codes], index=offsets.index)
+    return labels.where(valid, default_session_label)
+
+
 def cleanup_row_dict(row_dict):
     """
     Cleanup session age, clinical notes, other notes, and empty values.
@@ -95,18 +178,70 @@ def cleanup_row_dict(row_dict):
     row_dict["session_age"] = int(row_dict["session_age"])
     # fix notes
     if row_dict.get("Unnamed: 16"):
-        row_dict["clinical notes"] = "\s".join(
+        row_dict["clinical notes"] = " ".join(
             [row_dict["clinical notes"], row_dict["other notes"]]
         )
         row_dict["other notes"] = row_dict["Unnamed: 16"]
         row_dict["Unnamed: 16"] = ""
 
-    # Copy row_dict
-    return_dict = copy.deepcopy(row_dict)
-
     # To remove empty values
-    for key, value in row_dict.items():
-        if value in ["", None]:
-            return_dict.pop(key)
+    return {key: value for key, value in row_dict.items() if not _is_empty(value)}
+
+
+def iter_cleaned_records(records, chunk_size=CLEANUP_CHUNK_SIZE):
+    """
+    Lazily cleanup the rows of a dataframe, as `cleanup_row_dict` does.
 
-    return return_dict
+    A dataframe is cleaned `chunk_size` rows at a time with column operations, so
+    memory stays flat regardless of its size and the dataframe itself is left as is.
+
+    Args:
+        records (pandas.DataFrame or iterable): A dataframe, or raw dictionary
+            representations of dataframe rows.
+        chunk_size (int, optional): Number of dataframe rows cleaned at once.
+            Defaults to CLEANUP_CHUNK_SIZE.
+
+    Yields:
+        dict: Cleaned version of each row.
+    """
+    if not isinstance(records, pd.DataFrame):
+        for row_dict in records:
+            yield cleanup_row_dict(row_dict)
+        return
+
+    columns = list(records.columns)
+    for start in range(0, len(records), chunk_size):
+        chunk = records.iloc[start : start + chunk_size]
+        values = {column: chunk[column].to_numpy(dtype=object) for column in columns}
+
+        # fix session age
+        values["session_age"] = (
+            chunk["session_age"].astype("int64").to_numpy(dtype=object)
+        )
+        # fix notes
+        if "Unnamed: 16" in values:
+            has_notes = chunk["Unnamed: 16"].astype(bool).to_numpy()
+            if has_notes.any():
+                clinical_notes = values["clinical notes"].copy()
+                other_notes = values["other notes"].copy()
+                unnamed = values["Unnamed: 16"].copy()
+                clinical_notes[has_notes] = (
+                    clinical_notes[has_notes] + " " + other_notes[has_notes]
+                )
+                other_notes[has_notes] = unnamed[has_notes]
+                unnamed[has_notes] = ""
+                values["clinical notes"] = clinical_notes
+                values["other notes"] = other_notes
+                values["Unnamed: 16"] = unnamed
+
+        # To remove empty values
+        for row in zip(*(values[column] for column in columns)):
+            yield {
+                column: value
+                for column, value in zip(columns, row)
+                if not _is_empty(value)
+            }
+
+
+def _is_empty(value):
+    return value is None or (isinstance(value, str) and value == "")
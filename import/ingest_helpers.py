@@ -0,0 +1,377 @@
+"""
+A concurrent pipeline to import the rows of a tabular dataset into a Flywheel Project.
+
+Each row is mapped to a record by a user-provided function. Records then go through
+four stages, each running on its own worker threads and connected by bounded queues:
+
+    resolve -> package -> upload -> update
+
+    resolve: Find or create the Subject, Session and Acquisition of the record.
+        Records of the same Subject are resolved one at a time to avoid duplicates.
+    package: Produce the file to upload (e.g. zip a DICOM).
+    upload: Upload the file to the Acquisition.
+    update: Update the metadata of the uploaded file.
+
+A record is a dictionary like:
+
+    {
+        "subject": {"label": "sub_0001", "sex": "male"},
+        "session": {"label": "offset_000", "age": 1234},
+        "acquisition": {"label": "Chest XR", "info": {...}},
+        "file": {"path": "/path/to/file.png", "info": {...}, "type": "image"},
+    }
+
+where every key other than "label" (or "path") is metadata passed on to the
+`container_helpers` functions. An optional "key" uniquely identifies the record in
+the manifest of a resumable run; it defaults to the labels and file name.
+"""
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from collections import defaultdict
+
+import flywheel
+
+from container_helpers import (
+    MetadataWriteBuffer,
+    ProjectHierarchyIndex,
+    find_or_create_acquisition,
+    find_or_create_session,
+    find_or_create_subject,
+    update_metadata,
+    upload_file_to_acquisition,
+)
+
+log = logging.getLogger(__name__)
+
+STAGES = ("resolve", "package", "upload", "update")
+
+DEFAULT_WORKERS = {"resolve": 4, "package": 2, "upload": 4, "update": 2}
+
+DEFAULT_QUEUE_SIZE = 64
+
+# Marks the end of the records in a stage queue
+_DONE = object()
+
+
+def record_key(record):
+    """
+    Return the key identifying "record" in the manifest of a run.
+
+    Args:
+        record (dict): A record, as returned by the `map_row` function of a pipeline.
+
+    Returns:
+        str: The "key" of the record, or its labels and file name joined by "/".
+    """
+    if record.get("key"):
+        return str(record["key"])
+    return "/".join(
+        [
+            str(record["subject"]["label"]),
+            str(record["session"]["label"]),
+            str(record["acquisition"]["label"]),
+            os.path.basename(record["file"]["path"]),
+        ]
+    )
+
+
+def _upload_name(fp):
+    """Return the name of the file uploaded from "fp", a path or file spec."""
+    if isinstance(fp, flywheel.FileSpec):
+        return fp.name
+    return os.path.basename(fp)
+
+
+class IngestPipeline:
+    """
+    Import rows into a Flywheel Project with concurrent, bounded stages.
+
+    Args:
+        fw_client (flywheel.Client): An active client to a Flywheel instance.
+        project (flywheel.Project): The Project to import the rows into.
+        map_row (callable): Maps a row to a record (see module docstring), or to
+            None to skip the row. Rows it fails to map are logged and counted as
+            failed.
+        package (callable, optional): Maps a record to the path of the file to
+            upload, or to a flywheel.FileSpec of in-memory contents (see
+            `container_helpers.zip_files`). Defaults to None, to upload
+            record["file"]["path"].
+        cleanup (callable, optional): Called with the uploaded path or file spec
+            once the upload is over, e.g. to remove a temporary file. Defaults to None.
+        manifest_path (Path-like, optional): File recording the key of each imported
+            record. Records found in it are skipped, so an interrupted run can be
+            resumed. Defaults to None.
+        workers (dict, optional): Number of worker threads per stage. Defaults to
+            DEFAULT_WORKERS.
+        queue_size (int, optional): Max number of records waiting between two
+            stages. Defaults to DEFAULT_QUEUE_SIZE.
+        index (ProjectHierarchyIndex, optional): Index of the Project. Defaults to
+            None, to load one at the start of the run.
+        max_pending (int, optional): Number of containers with pending metadata
+            updates that triggers a write. Metadata updates are coalesced per
+            container and records are only saved to the manifest once written.
+            Defaults to None, for METADATA_MAX_PENDING.
+    """
+
+    def __init__(
+        self,
+        fw_client,
+        project,
+        map_row,
+        package=None,
+        cleanup=None,
+        manifest_path=None,
+        workers=None,
+        queue_size=DEFAULT_QUEUE_SIZE,
+        index=None,
+        max_pending=None,
+    ):
+        self.fw_client = fw_client
+        self.project = project
+        self.map_row = map_row
+        self.package = package
+        self.cleanup = cleanup
+        self.manifest_path = manifest_path
+        self.workers = dict(DEFAULT_WORKERS, **(workers or {}))
+        self.queue_size = queue_size
+        self.index = index
+        self.max_pending = max_pending
+        self.writer = None
+        self._lock = threading.Lock()
+        self._subject_locks = defaultdict(threading.Lock)
+        self._stats = {}
+
+    def run(self, rows):
+        """
+        Import "rows" and return a per-stage throughput report.
+
+        Args:
+            rows (iterable): The rows to import, e.g. `df.to_dict(orient="records")`.
+
+        Returns:
+            dict: The number of records imported, skipped and failed, the elapsed
+                time, the metadata requests and failed container writes and, for
+                each stage, the number of records processed, the errors, the busy
+                time of its workers and its throughput.
+        """
+        if self.index is None:
+            self.index = ProjectHierarchyIndex(self.fw_client, self.project)
+        done_keys = self._load_manifest()
+        self.writer = MetadataWriteBuffer(
+            max_pending=self.max_pending, on_flush=self._save_to_manifest
+        )
+
+        self._stats = {
+            stage: {"records": 0, "errors": 0, "busy_time": 0.0} for stage in STAGES
+        }
+        skipped = 0
+        start = time.perf_counter()
+
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in STAGES]
+        threads = []
+        for i, stage in enumerate(STAGES):
+            out_queue = queues[i + 1] if i + 1 < len(STAGES) else None
+            running = [self.workers[stage]]
+            for _ in range(self.workers[stage]):
+                thread = threading.Thread(
+                    target=self._work,
+                    args=(stage, queues[i], out_queue, running),
+                    daemon=True,
+                )
+                thread.start()
+                threads.append(thread)
+
+        map_errors = 0
+        try:
+            for i, row in enumerate(rows):
+                try:
+                    record = self.map_row(row)
+                    key = record_key(record) if record is not None else None
+                except Exception:
+                    log.exception("Failed to map row %d.", i)
+                    map_errors += 1
+                    continue
+                if record is None or key in done_keys:
+                    skipped += 1
+                    continue
+                # Blocks while the resolve stage is behind
+                queues[0].put({"key": key, "record": record})
+        finally:
+            # Lets the workers stop even if the rows cannot be read
+            queues[0].put(_DONE)
+
+        for thread in threads:
+            thread.join()
+        self.writer.flush()
+
+        elapsed = time.perf_counter() - start
+        return self._report(elapsed, skipped, map_errors)
+
+    def _work(self, stage, in_queue, out_queue, running):
+        handler = getattr(self, f"_{stage}")
+        while True:
+            item = in_queue.get()
+            if item is _DONE:
+                # Let the other workers of the stage stop too
+                in_queue.put(_DONE)
+                with self._lock:
+                    running[0] -= 1
+                    last = running[0] == 0
+                if last and out_queue is not None:
+                    out_queue.put(_DONE)
+                return
+
+            start = time.perf_counter()
+            try:
+                item = handler(item)
+                failed = False
+            except Exception:
+                log.exception("Stage %s failed for record %s.", stage, item["key"])
+                failed = True
+            busy_time = time.perf_counter() - start
+
+            with self._lock:
+                stats = self._stats[stage]
+                stats["busy_time"] += busy_time
+                if failed:
+                    stats["errors"] += 1
+                elif item is not None:
+                    stats["records"] += 1
+
+            if not failed and item is not None and out_queue is not None:
+                out_queue.put(item)
+
+    def _subject_lock(self, label):
+        with self._lock:
+            return self._subject_locks[label]
+
+    def _resolve(self, item):
+        record = item["record"]
+        subject_kwargs = dict(record["subject"])
+        subject_label = subject_kwargs.pop("label")
+
+        with self._subject_lock(subject_label):
+            subject = find_or_create_subject(
+                subject_label,
+                self.project,
+                index=self.index,
+                writer=self.writer,
+                **subject_kwargs,
+            )
+            if not subject:
+                log.warning("No subject label for record %s. Skipping.", item["key"])
+                return None
+
+            session_kwargs = dict(record["session"])
+            session = find_or_create_session(
+                session_kwargs.pop("label"),
+                subject,
+                index=self.index,
+                writer=self.writer,
+                **session_kwargs,
+            )
+            if not session:
+                log.warning("No session label for record %s. Skipping.", item["key"])
+                return None
+
+            acq_kwargs = dict(record["acquisition"])
+            acq = find_or_create_acquisition(
+                acq_kwargs.pop("label"),
+                session,
+                index=self.index,
+                writer=self.writer,
+                **acq_kwargs,
+            )
+            if not acq:
+                log.warning("No acquisition label for record %s. Skipping.", item["key"])
+                return None
+
+        item["containers"] = [subject, session, acq]
+        item["acquisition"] = acq
+        return item
+
+    def _package(self, item):
+        if self.package:
+            item["path"] = self.package(item["record"])
+        else:
+            item["path"] = item["record"]["file"]["path"]
+        return item
+
+    def _upload(self, item):
+        try:
+            file_entry = upload_file_to_acquisition(
+                item["acquisition"], item["path"], update=False
+            )
+            if file_entry is None:
+                # Uploaded by an interrupted run, its metadata may not be written
+                file_entry = item["acquisition"].get_file(_upload_name(item["path"]))
+            item["file_entry"] = file_entry
+        finally:
+            if self.cleanup:
+                self.cleanup(item["path"])
+        return item
+
+    def _update(self, item):
+        file_kwargs = dict(item["record"]["file"])
+        file_kwargs.pop("path")
+        if item["file_entry"] and file_kwargs:
+            update_metadata(item["file_entry"], writer=self.writer, **file_kwargs)
+        # Saved to the manifest once the metadata updates of its containers and
+        # file queued so far are written
+        containers = list(item["containers"])
+        if item["file_entry"]:
+            containers.append(item["file_entry"])
+        self.writer.mark(item["key"], *containers)
+        return item
+
+    def _load_manifest(self):
+        if not self.manifest_path or not os.path.exists(self.manifest_path):
+            return set()
+        with open(self.manifest_path, "r") as fp:
+            done_keys = {json.loads(line)["key"] for line in fp if line.strip()}
+        log.info("Resuming, %d records already imported.", len(done_keys))
+        return done_keys
+
+    def _save_to_manifest(self, keys):
+        if not self.manifest_path or not keys:
+            return
+        with self._lock:
+            with open(self.manifest_path, "a") as fp:
+                for key in keys:
+                    fp.write(json.dumps({"key": key}) + "\n")
+
+    def _report(self, elapsed, skipped, map_errors):
+        report = {
+            "imported": self._stats["update"]["records"],
+            "skipped": skipped,
+            "failed": map_errors
+            + sum(stats["errors"] for stats in self._stats.values()),
+            "elapsed": elapsed,
+            "metadata_requests": self.writer.requests,
+            "metadata_errors": self.writer.errors,
+            "stages": {},
+        }
+        for stage in STAGES:
+            stats = dict(self._stats[stage])
+            stats["throughput"] = stats["records"] / elapsed if elapsed else 0.0
+            report["stages"][stage] = stats
+            log.info(
+                "%-8s %6d records, %4d errors, %8.2f s busy, %7.2f records/s",
+                stage,
+                stats["records"],
+                stats["errors"],
+                stats["busy_time"],
+                stats["throughput"],
+            )
+        log.info(
+            "Imported %d records in %.2f s (%d skipped, %d failed).",
+            report["imported"],
+            elapsed,
+            skipped,
+            report["failed"],
+        )
+        return report
@@ -0,0 +1,130 @@
+"""
+The following are helper functions for scripts sending many requests to the
+Flywheel API, e.g. to submit, retry or cancel jobs in bulk.
+"""
+import datetime
+import logging
+import random
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# Number of times a request failing with a transient error is retried
+API_RETRIES = 5
+# First and max delays (in seconds) before retrying a request
+API_RETRY_DELAY = 0.5
+API_RETRY_MAX_DELAY = 30
+
+
+def format_timestamp(timestamp):
+    """Format a datetime for a find filter, e.g. "modified>{...}".
+
+    Args:
+        timestamp (datetime.datetime): A datetime, naive ones being in UTC.
+
+    Returns:
+        str: The UTC datetime, as YYYY-MM-DDTHH:MM:SS.
+    """
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(datetime.timezone.utc)
+    return timestamp.strftime("%Y-%m-%dT%H:%M:%S")
+
+
+def is_transient_error(exc):
+    """Return True if "exc" is an API error worth retrying.
+
+    Server errors (5xx) and rate limiting (429) are transient, any other error
+    (e.g. 400, 403 or 404) will fail again.
+
+    Args:
+        exc (Exception): The error raised by a request, e.g. a
+            flywheel.rest.ApiException.
+
+    Returns:
+        bool: True if the request can be retried.
+    """
+    status = getattr(exc, "status", None)
+    return isinstance(status, int) and (status >= 500 or status == 429)
+
+
+def call_with_retry(
+    request,
+    retries=API_RETRIES,
+    delay=API_RETRY_DELAY,
+    max_delay=API_RETRY_MAX_DELAY,
+    on_retry=None,
+    is_transient=is_transient_error,
+):
+    """Send a request, retrying it with exponential backoff on transient errors.
+
+    Args:
+        request (callable): Sends the request, e.g.
+            `functools.partial(gear.run, inputs=inputs, destination=dest)`.
+        retries (int): Max number of retries. Defaults to API_RETRIES.
+        delay (float): Delay (in seconds) before the first retry, doubled on each
+            retry. Defaults to API_RETRY_DELAY.
+        max_delay (float): Max delay (in seconds) between two attempts. Defaults to
+            API_RETRY_MAX_DELAY.
+        on_retry (callable, optional): Called with the attempt number and the error
+            before each retry, e.g. to count them. Defaults to None.
+        is_transient (callable): Returns True if an error is worth retrying.
+            Defaults to is_transient_error.
+
+    Returns:
+        The result of the request.
+
+    Raises:
+        Exception: The error of the last attempt, or the first non-transient error.
+    """
+    attempt = 0
+    while True:
+        try:
+            return request()
+        except Exception as exc:
+            if attempt >= retries or not is_transient(exc):
+                raise
+            attempt += 1
+            if on_retry:
+                on_retry(attempt, exc)
+            log.debug("Transient error (%s), retry %d of %d.", exc, attempt, retries)
+            # Jitter, so concurrent workers do not retry in lockstep
+            time.sleep(random.uniform(delay / 2, delay))
+            delay = min(delay * 2, max_delay)
+
+
+class TokenBucket:
+    """Rate limiter letting `rate` requests per second through. Thread-safe.
+
+    After an idle period, up to `capacity` requests are let through at once.
+
+    Args:
+        rate (float): Number of requests per second.
+        capacity (int, optional): Max number of requests sent at once after an idle
+            period. Defaults to None, for `rate` (at least 1).
+        clock (callable): Returns a monotonic time, in seconds. Defaults to
+            time.monotonic.
+    """
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self.clock = clock
+        self._tokens = self.capacity
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Wait until a request can be sent, and take its token."""
+        while True:
+            with self._lock:
+                now = self.clock()
+                self._tokens = min(
+                    self.capacity, self._tokens + (now - self._updated) * self.rate
+                )
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
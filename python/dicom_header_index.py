@@ -0,0 +1,281 @@
+"""
+The following are helper functions to query the DICOM header fields of the files
+of a whole Project locally.
+
+`DicomHeaderIndex` is a columnar table (NumPy arrays) with a row per DICOM file of
+a Project, keyed by file id. It is built once, then each update only lists the
+Acquisitions modified since the previous one, and only fetches the Acquisitions
+(to get the `info` of their files) whose DICOM files changed:
+
+    index = DicomHeaderIndex("dicom_headers.npz")
+    index.update(fw, project)
+    df = index.to_frame()
+    df[df.SeriesDescription.str.contains("moco", case=False)]
+
+The table is saved to a NumPy file, so the next session starts from it.
+"""
+import datetime
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from api_helpers import format_timestamp
+
+log = logging.getLogger(__name__)
+
+# DICOM header fields (from the `info` of the files) indexed by default, with
+# their type: float (NaN if missing) or str (empty if missing)
+DICOM_INDEX_FIELDS = {
+    "SeriesNumber": float,
+    "SeriesTime": str,
+    "SeriesDescription": str,
+    "SeriesInstanceUID": str,
+    "Modality": str,
+    "StudyDate": str,
+}
+
+# Columns of a DicomHeaderIndex before the header fields, with their NumPy type
+# (datetimes are in UTC)
+INDEX_COLUMNS = {
+    "file_id": str,
+    "file_name": str,
+    "file_modified": "datetime64[us]",
+    "acq_id": str,
+    "acq_label": str,
+    "acq_timestamp": "datetime64[us]",
+    "session_id": str,
+    "subject_id": str,
+}
+
+# Number of Acquisitions fetched at once
+INDEX_WORKERS = 8
+
+# Time (in seconds) the modified window of an update overlaps the previous one,
+# so Acquisitions modified while the previous update was running are not missed
+INDEX_SYNC_OVERLAP = 60
+
+
+def to_datetime64(value):
+    """Return a datetime as a UTC numpy.datetime64, or NaT if None."""
+    if value is None:
+        return np.datetime64("NaT", "us")
+    if value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    return np.datetime64(value, "us")
+
+
+def header_value(info, field, field_type):
+    """Return the value of a header field of a file `info`, as `field_type`."""
+    value = (info or {}).get(field)
+    if field_type is float:
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return np.nan
+    if value is None:
+        return ""
+    if isinstance(value, (list, tuple)):
+        # As in DICOM, multiple values are separated by backslashes
+        return "\\".join(str(item) for item in value)
+    return str(value)
+
+
+class DicomHeaderIndex:
+    """Columnar table of the DICOM header fields of the files of a Project.
+
+    Each update lists the Acquisitions of the Project modified since the previous
+    update (minus INDEX_SYNC_OVERLAP seconds), and only fetches those with new or
+    modified DICOM files, as listed Acquisitions do not include the `info` of
+    their files. The header fields of unchanged files are kept.
+
+    Deleted Acquisitions are not listed by incremental updates: use `full=True` to
+    list all the Acquisitions and drop the rows of the deleted ones.
+
+    Args:
+        path (Path-like, optional): The .npz file the index is saved to and loaded
+            from. Defaults to None, for an in-memory index.
+        fields (dict, optional): The header fields to index, with their type (float
+            or str). Defaults to None, for DICOM_INDEX_FIELDS.
+        workers (int): Number of Acquisitions fetched at once. Defaults to
+            INDEX_WORKERS.
+    """
+
+    def __init__(self, path=None, fields=None, workers=INDEX_WORKERS):
+        self.path = path
+        self.fields = dict(fields or DICOM_INDEX_FIELDS)
+        self.workers = workers
+        self.project_id = None
+        self.last_modified = None
+        self.columns = self._empty_columns()
+        if path and os.path.exists(path):
+            self.load()
+
+    def __len__(self):
+        return len(self.columns["file_id"])
+
+    def to_frame(self):
+        """Return the index as a pandas.DataFrame, with a row per DICOM file."""
+        import pandas as pd
+
+        return pd.DataFrame(self.columns)
+
+    def update(self, fw_client, project, full=False):
+        """Index the DICOM files of the Acquisitions modified since the last update.
+
+        Args:
+            fw_client (flywheel.Client): An active client to a Flywheel instance.
+            project (flywheel.Project): The Project to index. The index is rebuilt
+                if it was built for another Project.
+            full (bool): List all the Acquisitions, dropping the rows of the deleted
+                ones. Files that did not change are still not fetched. Defaults to
+                False.
+
+        Returns:
+            dict: The number of Acquisitions listed and fetched, and of rows.
+        """
+        if project.id != self.project_id:
+            self.project_id = project.id
+            self.last_modified = None
+            self.columns = self._empty_columns()
+
+        acq_filter = f"parents.project={project.id}"
+        if self.last_modified is not None and not full:
+            # Acquisitions seen again in the overlap are not fetched if unchanged
+            overlap = datetime.timedelta(seconds=INDEX_SYNC_OVERLAP)
+            since = self.last_modified - overlap
+            acq_filter += f",modified>{format_timestamp(since)}"
+        acquisitions = list(fw_client.acquisitions.iter_find(acq_filter))
+
+        known = dict(zip(self.columns["file_id"], self.columns["file_modified"]))
+        changed = [acq for acq in acquisitions if self._has_changed(acq, known)]
+        with ThreadPoolExecutor(self.workers) as executor:
+            fetched = {
+                acq.id: acq
+                for acq in executor.map(
+                    lambda acq: fw_client.get_acquisition(acq.id), changed
+                )
+            }
+
+        rows = []
+        row_by_file = {file_id: i for i, file_id in enumerate(self.columns["file_id"])}
+        for acq in acquisitions:
+            acq = fetched.get(acq.id, acq)
+            for file_obj in acq.files or []:
+                if file_obj.type != "dicom":
+                    continue
+                if acq.id in fetched:
+                    info = file_obj.info
+                    header = [
+                        header_value(info, field, field_type)
+                        for field, field_type in self.fields.items()
+                    ]
+                else:
+                    # Unchanged file, its header fields are kept
+                    i = row_by_file[file_obj.file_id]
+                    header = [self.columns[field][i] for field in self.fields]
+                rows.append(
+                    [
+                        file_obj.file_id,
+                        file_obj.name,
+                        to_datetime64(file_obj.modified),
+                        acq.id,
+                        acq.label,
+                        to_datetime64(acq.timestamp),
+                        getattr(acq.parents, "session", None) or "",
+                        getattr(acq.parents, "subject", None) or "",
+                    ]
+                    + header
+                )
+            if self.last_modified is None or acq.modified > self.last_modified:
+                self.last_modified = acq.modified
+
+        if full:
+            keep = np.zeros(len(self), dtype=bool)
+        else:
+            listed = [acq.id for acq in acquisitions]
+            keep = ~np.isin(self.columns["acq_id"], listed)
+        new_columns = self._make_columns(rows)
+        self.columns = {
+            name: np.concatenate([column[keep], new_columns[name]])
+            for name, column in self.columns.items()
+        }
+
+        if self.path:
+            self.save()
+        log.info(
+            "Listed %d acquisitions, fetched %d, %d DICOM files indexed.",
+            len(acquisitions),
+            len(fetched),
+            len(self),
+        )
+        return {
+            "listed": len(acquisitions),
+            "fetched": len(fetched),
+            "rows": len(self),
+        }
+
+    def save(self):
+        """Save the index to its path."""
+        meta = {
+            "project_id": self.project_id,
+            "fields": self._field_types(),
+            "last_modified": (
+                self.last_modified.isoformat() if self.last_modified else None
+            ),
+        }
+        tmp_path = f"{self.path}.tmp.npz"
+        np.savez(tmp_path, meta=np.array(json.dumps(meta)), **self.columns)
+        os.replace(tmp_path, self.path)
+
+    def load(self):
+        """Load the index from its path.
+
+        An index saved with other header fields (or timestamp units) is not loaded,
+        so it is rebuilt by the next update.
+        """
+        with np.load(self.path, allow_pickle=False) as data:
+            meta = json.loads(str(data["meta"]))
+            if meta["fields"] != self._field_types():
+                log.info("The index has other header fields, it will be rebuilt.")
+                return
+            if any(
+                data[name].dtype != np.dtype(column_type)
+                for name, column_type in INDEX_COLUMNS.items()
+                if column_type is not str
+            ):
+                log.info("The index has other timestamp units, it will be rebuilt.")
+                return
+            self.columns = {name: data[name] for name in self.columns}
+        self.project_id = meta["project_id"]
+        self.last_modified = (
+            datetime.datetime.fromisoformat(meta["last_modified"])
+            if meta["last_modified"]
+            else None
+        )
+
+    def _has_changed(self, acq, known):
+        """Return True if "acq" has new or modified DICOM files, or unknown files."""
+        if acq.files is None:
+            return True
+        return any(
+            file_obj.type == "dicom"
+            and known.get(file_obj.file_id) != to_datetime64(file_obj.modified)
+            for file_obj in acq.files
+        )
+
+    def _field_types(self):
+        return {field: field_type.__name__ for field, field_type in self.fields.items()}
+
+    def _empty_columns(self):
+        return self._make_columns([])
+
+    def _make_columns(self, rows):
+        types = dict(INDEX_COLUMNS, **self.fields)
+        values = list(zip(*rows)) if rows else [[] for _ in types]
+        return {
+            name: np.array(column, dtype=column_type)
+            for (name, column_type), column in zip(types.items(), values)
+        }
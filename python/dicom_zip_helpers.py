@@ -0,0 +1,375 @@
+"""
+The following are helper functions to read the DICOM members of a zip archive
+stored in Flywheel (e.g. a DICOM series), without downloading the archive.
+
+The zip info of the archive is fetched once, then its members are read several at
+once and parsed as they arrive:
+
+    for path, ds in iter_zip_dicoms(acq, "series.dicom.zip", stop_before_pixels=True):
+        print(path, ds.InstanceNumber)
+
+Datasets are yielded lazily, with at most a few members read ahead of the caller,
+so a large series is never held in memory at once. With `stop_before_pixels`,
+the pixel data is not parsed, which is enough to survey headers.
+
+A `ZipMemberCache` keeps the zip info and members read on the local disk, so the
+same archive can be explored repeatedly without network traffic:
+
+    cache = ZipMemberCache("/tmp/fw-zip-cache")
+    for path, ds in iter_zip_dicoms(cache.wrap(acq), "series.dicom.zip"):
+        ...
+
+The cached version of an archive is checked once per `wrap`, against its file
+entry as reloaded from Flywheel. An archive replaced while a wrapped container is
+in use is still read from the cache until the container is wrapped again.
+"""
+import collections
+import functools
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import pydicom
+from pydicom.filebase import DicomBytesIO
+
+from api_helpers import API_RETRIES, call_with_retry
+
+log = logging.getLogger(__name__)
+
+# Number of zip members read at once
+ZIP_MEMBER_WORKERS = 8
+
+# Number of zip members read ahead of the caller, per worker
+ZIP_MEMBER_READ_AHEAD = 2
+
+# Max size (in bytes) of a ZipMemberCache on disk
+ZIP_CACHE_MAX_SIZE = 2 * 1024**3
+
+# Name of the zip info file of an archive in a ZipMemberCache
+ZIP_INFO_NAME = "zip_info.json"
+
+
+def dicom_member_paths(zip_info):
+    """Return the paths of the members of a zip archive that can be DICOM files.
+
+    Args:
+        zip_info (flywheel.FileZipInfo): As returned by `get_file_zip_info`.
+
+    Returns:
+        list: The paths of the members that are not directories or empty.
+    """
+    return [
+        member.path
+        for member in zip_info.members
+        if not member.path.endswith("/") and member.size
+    ]
+
+
+def read_zip_dicom(
+    container,
+    file_name,
+    member_path,
+    stop_before_pixels=False,
+    specific_tags=None,
+    retries=API_RETRIES,
+):
+    """Read a zip member and parse it as a DICOM dataset.
+
+    Args:
+        container: The parent of the zip archive, e.g. a flywheel.Acquisition or
+            flywheel.AnalysisOutput.
+        file_name (str): Name of the zip archive.
+        member_path (str): Path of the member in the archive.
+        stop_before_pixels (bool): Do not parse the pixel data. Defaults to False.
+        specific_tags (list, optional): Only parse these tags (keywords or tags,
+            e.g. ["PatientID", "InstanceNumber"]). Defaults to None, for all tags.
+        retries (int): Max number of retries of a read failing with a transient
+            error. Defaults to API_RETRIES.
+
+    Returns:
+        pydicom.Dataset: The dataset of the member.
+    """
+    raw = call_with_retry(
+        functools.partial(container.read_file_zip_member, file_name, member_path),
+        retries=retries,
+    )
+    return pydicom.dcmread(
+        DicomBytesIO(raw),
+        force=True,
+        stop_before_pixels=stop_before_pixels,
+        specific_tags=specific_tags,
+    )
+
+
+def iter_zip_dicoms(
+    container,
+    file_name,
+    members=None,
+    zip_info=None,
+    stop_before_pixels=False,
+    specific_tags=None,
+    workers=ZIP_MEMBER_WORKERS,
+):
+    """Read the DICOM members of a zip archive concurrently, and yield them in order.
+
+    Args:
+        container: The parent of the zip archive, e.g. a flywheel.Acquisition.
+        file_name (str): Name of the zip archive.
+        members (list, optional): Paths of the members to read. Defaults to None,
+            for all the members returned by `dicom_member_paths`.
+        zip_info (flywheel.FileZipInfo, optional): The zip info of the archive, if
+            already fetched. Defaults to None, to fetch it when needed.
+        stop_before_pixels (bool): Do not parse the pixel data. Defaults to False.
+        specific_tags (list, optional): Only parse these tags. Defaults to None.
+        workers (int): Number of members read at once. Defaults to
+            ZIP_MEMBER_WORKERS.
+
+    Yields:
+        tuple: The path of the member and its pydicom.Dataset.
+    """
+    if members is None:
+        if zip_info is None:
+            zip_info = container.get_file_zip_info(file_name)
+        members = dicom_member_paths(zip_info)
+    read = functools.partial(
+        read_zip_dicom,
+        container,
+        file_name,
+        stop_before_pixels=stop_before_pixels,
+        specific_tags=specific_tags,
+    )
+
+    with ThreadPoolExecutor(workers) as executor:
+        pending = collections.deque()
+        try:
+            for path in members:
+                pending.append((path, executor.submit(read, path)))
+                # Bounds the datasets held in memory when the caller is slower
+                if len(pending) >= workers * ZIP_MEMBER_READ_AHEAD:
+                    path, future = pending.popleft()
+                    yield path, future.result()
+            while pending:
+                path, future = pending.popleft()
+                yield path, future.result()
+        finally:
+            # Stop reading ahead if the caller stops early
+            for _, future in pending:
+                future.cancel()
+
+
+def _digest(*parts):
+    return hashlib.sha256("|".join(str(part) for part in parts).encode()).hexdigest()
+
+
+class ZipMemberCache:
+    """Local cache of the zip info and members of zip archives, bounded in size.
+
+    The entries of an archive are keyed by its container and name, then by its file
+    id, version, hash and modified timestamp. When one of these changes (e.g. the
+    container was reloaded after the archive was replaced), the previous entries
+    of the archive are removed. The least recently used files are evicted once the
+    cache is larger than `max_size`, and recency is kept across sessions through
+    their modification time.
+
+    Args:
+        root (Path-like): Local directory of the cache.
+        max_size (int): Max size (in bytes) of the cache. Defaults to
+            ZIP_CACHE_MAX_SIZE.
+    """
+
+    def __init__(self, root, max_size=ZIP_CACHE_MAX_SIZE):
+        self.root = str(root)
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # Size of each cached file, least recently used first
+        self._files = collections.OrderedDict()
+        os.makedirs(self.root, exist_ok=True)
+        self._scan()
+        self._evict()
+
+    def wrap(self, container):
+        """Return a view of "container" reading its zip archives through the cache.
+
+        Args:
+            container: The parent of the zip archives, e.g. a flywheel.Acquisition.
+                It is reloaded on first use to check which version of an archive
+                is cached.
+
+        Returns:
+            CachedZipContainer: Has the `get_file_zip_info` and
+                `read_file_zip_member` methods of the container, e.g. for
+                `iter_zip_dicoms`. Other attributes are the container's.
+        """
+        return CachedZipContainer(self, container)
+
+    def get(self, path):
+        """Return the contents of a cached file, or None if not cached."""
+        try:
+            with open(path, "rb") as fp:
+                data = fp.read()
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        # Marks the file as recently used, also for the next sessions
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # Evicted since it was read, its contents are still returned
+            pass
+        with self._lock:
+            self.hits += 1
+            if path in self._files:
+                self._files.move_to_end(path)
+        return data
+
+    def put(self, path, data):
+        """Cache the contents of a file, evicting least recently used files."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as fp:
+            fp.write(data)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self.size += len(data) - self._files.pop(path, 0)
+            self._files[path] = len(data)
+        self._evict()
+
+    def _evict(self):
+        evicted = []
+        with self._lock:
+            # The most recently used file is kept, even if larger than max_size
+            while self.size > self.max_size and len(self._files) > 1:
+                old_path, old_size = self._files.popitem(last=False)
+                self.size -= old_size
+                evicted.append(old_path)
+        for old_path in evicted:
+            try:
+                os.remove(old_path)
+            except FileNotFoundError:
+                pass
+        if evicted:
+            log.debug("Evicted %d files from the zip cache.", len(evicted))
+
+    def entry_dir(self, container, file_entry):
+        """Return the directory of the cached version of an archive.
+
+        The directories of its other versions are removed.
+        """
+        archive_dir = os.path.join(self.root, _digest(container.id, file_entry.name))
+        version = _digest(
+            getattr(file_entry, "file_id", None),
+            getattr(file_entry, "version", None),
+            file_entry.hash,
+            file_entry.modified,
+        )
+        if os.path.isdir(archive_dir):
+            for name in os.listdir(archive_dir):
+                if name != version:
+                    self._remove(os.path.join(archive_dir, name))
+        return os.path.join(archive_dir, version)
+
+    def _remove(self, version_dir):
+        log.debug("Removing outdated zip cache entry %s.", version_dir)
+        prefix = version_dir + os.sep
+        with self._lock:
+            for path in [path for path in self._files if path.startswith(prefix)]:
+                self.size -= self._files.pop(path)
+        shutil.rmtree(version_dir, ignore_errors=True)
+
+    def _scan(self):
+        files = []
+        for dir_path, _, names in os.walk(self.root):
+            for name in names:
+                path = os.path.join(dir_path, name)
+                if name.endswith(".tmp"):
+                    os.remove(path)
+                    continue
+                stat = os.stat(path)
+                files.append((stat.st_mtime, path, stat.st_size))
+        for _, path, size in sorted(files):
+            self._files[path] = size
+            self.size += size
+
+
+class CachedZipContainer:
+    """A container reading its zip archives through a ZipMemberCache.
+
+    Args:
+        cache (ZipMemberCache): The cache.
+        container: The parent of the zip archives, e.g. a flywheel.Acquisition.
+    """
+
+    def __init__(self, cache, container):
+        self.cache = cache
+        self.container = container
+        self._entry_dirs = {}
+        # The container as reloaded on first use, with up to date file entries
+        self._reloaded = None
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.container, name)
+
+    def __getitem__(self, key):
+        return self.container[key]
+
+    def get_file_zip_info(self, file_name):
+        """Return the zip info of an archive, as a namespace of its members."""
+        path = os.path.join(self._entry_dir(file_name), ZIP_INFO_NAME)
+        data = self.cache.get(path)
+        if data is None:
+            zip_info = self.container.get_file_zip_info(file_name)
+            data = json.dumps(
+                {
+                    "comment": getattr(zip_info, "comment", None),
+                    "members": [
+                        {
+                            "path": member.path,
+                            "size": member.size,
+                            "timestamp": str(getattr(member, "timestamp", None)),
+                        }
+                        for member in zip_info.members
+                    ],
+                }
+            ).encode()
+            self.cache.put(path, data)
+        zip_info = json.loads(data)
+        return SimpleNamespace(
+            comment=zip_info["comment"],
+            members=[SimpleNamespace(**member) for member in zip_info["members"]],
+        )
+
+    def read_file_zip_member(self, file_name, member_path):
+        """Return the contents of a member of an archive."""
+        path = os.path.join(self._entry_dir(file_name), _digest(member_path))
+        data = self.cache.get(path)
+        if data is None:
+            data = self.container.read_file_zip_member(file_name, member_path)
+            self.cache.put(path, data)
+        return data
+
+    def _entry_dir(self, file_name):
+        # Looked up once, from the container reloaded once, as the file entries
+        # loaded with it may be outdated
+        with self._lock:
+            if file_name not in self._entry_dirs:
+                if self._reloaded is None:
+                    self._reloaded = call_with_retry(self.container.reload)
+                file_entry = self._reloaded.get_file(file_name)
+                if file_entry is None:
+                    raise ValueError(
+                        f"File {file_name} not found in {self.container.id}."
+                    )
+                self._entry_dirs[file_name] = self.cache.entry_dir(
+                    self.container, file_entry
+                )
+            return self._entry_dirs[file_name]
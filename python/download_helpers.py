@@ -0,0 +1,691 @@
+"""
+The following are helper functions to download many files from Flywheel, e.g. all
+the files of a Collection.
+
+The files are first listed into a manifest, then downloaded by a bounded pool of
+worker threads:
+
+    downloader = CollectionDownloader(fw, "/data", manifest_path="download.jsonl")
+    report = downloader.run(collection, file_type="nifti")
+
+A file is skipped if the local copy already matches it (size, and hash if
+`verify_hash`), and written to a temporary file renamed once complete, so a file
+at its destination is never partial. The manifest records the listing and each
+downloaded file, so an interrupted run resumes without listing the Collection again.
+
+Large files can be downloaded with HTTP range requests by a `RangedDownloader`,
+which resumes a transfer from the last byte written instead of from the start, and
+can fetch several ranges of a file at once:
+
+    ranged = RangedDownloader(workers=4)
+    downloader = CollectionDownloader(fw, "/data", ranged=ranged)
+"""
+import functools
+import hashlib
+import http.client
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from api_helpers import API_RETRIES, call_with_retry, is_transient_error
+
+log = logging.getLogger(__name__)
+
+# Number of files downloaded (or Sessions listed) at once
+DOWNLOAD_WORKERS = 8
+
+# Number of files between two progress logs
+DOWNLOAD_LOG_INTERVAL = 100
+
+# Size (in bytes) of the blocks read to hash a local file
+HASH_BLOCK_SIZE = 1024 * 1024
+
+# Suffix of the temporary file a download is written to
+PARTIAL_SUFFIX = ".part"
+
+# Suffix of the file recording the ranges of a partial file already downloaded
+RANGES_SUFFIX = ".ranges"
+
+# Size (in bytes) of the ranges of a file fetched at once
+RANGE_PART_SIZE = 64 * 1024 * 1024
+
+# Size (in bytes) of the blocks a response is streamed to disk with
+RANGE_CHUNK_SIZE = 1024 * 1024
+
+# Number of times a range request is retried, each retry resuming the range
+RANGE_RETRIES = 10
+
+# Timeout (in seconds) of the connection and of each read of a range request
+RANGE_TIMEOUT = 60
+
+
+def list_session_files(session, project_label, file_type=None):
+    """List the files of the Acquisitions of a Session.
+
+    Args:
+        session (flywheel.Session): The Session to list.
+        project_label (str): Label of the Project of the Session.
+        file_type (str, optional): Only list files of this type (e.g. "nifti").
+            Defaults to None.
+
+    Returns:
+        list: A manifest entry per file, with its local "path" (relative, as
+            project/subject/session/acquisition/file, assuming labels are POSIX
+            compliant), "size", "hash", "modified", "file_id", "parent_id" and
+            "name".
+    """
+    entries = []
+    for acq in session.acquisitions.iter():
+        for file_obj in acq.files:
+            if file_type and file_obj.type != file_type:
+                continue
+            entries.append(
+                {
+                    "path": os.path.join(
+                        project_label,
+                        session.subject.label,
+                        session.label,
+                        acq.label,
+                        file_obj.name,
+                    ),
+                    "size": file_obj.size,
+                    "hash": file_obj.hash,
+                    "modified": str(file_obj.modified),
+                    "file_id": file_obj.file_id,
+                    "parent_id": acq.id,
+                    "name": file_obj.name,
+                }
+            )
+    return entries
+
+
+def list_collection_files(
+    fw_client, collection, file_type=None, workers=DOWNLOAD_WORKERS
+):
+    """List the files of a Collection, listing several Sessions at once.
+
+    Args:
+        fw_client (flywheel.Client): An active client to a Flywheel instance.
+        collection (flywheel.Collection): The Collection to list.
+        file_type (str, optional): Only list files of this type. Defaults to None.
+        workers (int): Number of Sessions listed at once. Defaults to
+            DOWNLOAD_WORKERS.
+
+    Returns:
+        list: A manifest entry per file (see `list_session_files`).
+    """
+    get_project = functools.lru_cache()(fw_client.get_project)
+    sessions = list(collection.sessions.iter())
+    # Projects are looked up once each, before the Sessions are listed concurrently
+    labels = [get_project(session.project).label for session in sessions]
+    with ThreadPoolExecutor(workers) as executor:
+        listings = executor.map(
+            lambda args: list_session_files(*args, file_type=file_type),
+            zip(sessions, labels),
+        )
+        entries = [entry for listing in listings for entry in listing]
+    log.info("Listed %d files in %d sessions.", len(entries), len(sessions))
+    return entries
+
+
+def file_hash(path, algorithm):
+    """Return the hex digest of the contents of a local file."""
+    digest = hashlib.new(algorithm)
+    with open(path, "rb") as fp:
+        for block in iter(lambda: fp.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def matches_local_file(entry, path, verify_hash=False):
+    """Return True if the file at "path" is the file of a manifest entry.
+
+    Args:
+        entry (dict): A manifest entry (see `list_session_files`).
+        path (Path-like): The local file.
+        verify_hash (bool): Also compare the hash of the local file, when the
+            algorithm of the Flywheel hash is known (e.g. "v0-sha384-<hex>").
+            Defaults to False, to only compare sizes.
+
+    Returns:
+        bool: True if the local file exists and matches.
+    """
+    try:
+        if os.path.getsize(path) != entry["size"]:
+            return False
+    except OSError:
+        return False
+    if not verify_hash or not entry.get("hash"):
+        return True
+    parts = entry["hash"].split("-")
+    if len(parts) != 3 or parts[1] not in hashlib.algorithms_available:
+        log.debug("Unknown hash format for %s, comparing sizes only.", entry["path"])
+        return True
+    return file_hash(path, parts[1]) == parts[2]
+
+
+def is_transient_download_error(exc):
+    """Return True if a download can be resumed after "exc".
+
+    On top of the transient API errors (see `is_transient_error`), dropped
+    connections, timeouts and truncated responses are transient.
+
+    Args:
+        exc (Exception): The error raised while downloading.
+
+    Returns:
+        bool: True if the download can be retried.
+    """
+    if isinstance(getattr(exc, "status", None), int):
+        return is_transient_error(exc)
+    return isinstance(
+        exc,
+        (
+            ConnectionError,
+            socket.timeout,
+            http.client.HTTPException,
+            urllib.error.URLError,
+        ),
+    )
+
+
+def missing_ranges(size, done, part_size):
+    """Return the ranges of a file not downloaded yet.
+
+    Args:
+        size (int): Size of the file, in bytes.
+        done (list): (first, last) byte ranges (inclusive) already downloaded.
+        part_size (int): Max size of a returned range.
+
+    Returns:
+        list: (first, last) byte ranges (inclusive) covering the rest of the file.
+    """
+    missing = []
+    pos = 0
+    for first, last in sorted(done) + [(size, size)]:
+        end = min(first, size)
+        for start in range(pos, end, part_size):
+            missing.append((start, min(start + part_size, end) - 1))
+        pos = max(pos, last + 1)
+    return missing
+
+
+class RangedDownloader:
+    """Download files with HTTP range requests, resuming interrupted transfers.
+
+    Responses are streamed to disk `chunk_size` bytes at a time, so the memory used
+    does not depend on the size of the files. A request failing with a transient
+    error is retried from the last byte written, and a partial file left by a
+    previous run is resumed.
+
+    With several `workers`, a file is fetched as ranges of `part_size` bytes, several
+    at once. The ranges already written are then recorded next to the partial file
+    (with the RANGES_SUFFIX), as it is allocated to its full size upfront.
+
+    The version of the file and its ETag (or Last-Modified) on the server are also
+    recorded there. A partial file of another version is discarded, and requests
+    resuming a file send its ETag as If-Range, so a file changed on the server is
+    never completed with bytes of its previous content.
+
+    Args:
+        workers (int): Number of ranges of a file fetched at once. Defaults to 1,
+            to fetch files in a single stream.
+        part_size (int): Size (in bytes) of the ranges fetched at once. Defaults to
+            RANGE_PART_SIZE.
+        chunk_size (int): Size (in bytes) of the blocks streamed to disk. Defaults
+            to RANGE_CHUNK_SIZE.
+        retries (int): Max number of retries of a range. Defaults to RANGE_RETRIES.
+        timeout (float): Timeout (in seconds) of the connection and of each read.
+            Defaults to RANGE_TIMEOUT.
+    """
+
+    def __init__(
+        self,
+        workers=1,
+        part_size=RANGE_PART_SIZE,
+        chunk_size=RANGE_CHUNK_SIZE,
+        retries=RANGE_RETRIES,
+        timeout=RANGE_TIMEOUT,
+    ):
+        self.workers = workers
+        self.part_size = part_size
+        self.chunk_size = chunk_size
+        self.retries = retries
+        self.timeout = timeout
+
+    def download(self, get_url, path, size, version=None):
+        """Download a file to "path", resuming from the content already there.
+
+        Args:
+            get_url (callable): Returns the URL of the file. Called before each
+                request, e.g. to get a new signed URL.
+            path (Path-like): The (partial) local file.
+            size (int): Size of the file, in bytes.
+            version (str, optional): Identifies the content of the file, e.g. its
+                hash or modified timestamp. A partial file of another version is
+                discarded. Defaults to None.
+
+        Returns:
+            dict: The number of bytes downloaded and already on disk ("resumed"),
+                the number of retries, the elapsed time and the throughput (in
+                bytes per second).
+
+        Raises:
+            Exception: The error of a range that could not be downloaded. The
+                partial file is kept, so the download can be resumed, unless the
+                file changed on the server.
+        """
+        start = time.perf_counter()
+        ranges_path = str(path) + RANGES_SUFFIX
+        saved = self._load_ranges(path, ranges_path, size, version)
+        parallel = self.workers > 1 and size > self.part_size
+        part_size = self.part_size if parallel else max(size, 1)
+        pending = missing_ranges(size, saved["done"], part_size)
+        stats = {
+            "bytes": 0,
+            "resumed": size - sum(last - first + 1 for first, last in pending),
+            "retries": 0,
+        }
+        # The ranges written are tracked once the file is allocated to its full size
+        tracked = parallel or saved["tracked"]
+        state = {
+            "size": size,
+            "version": version,
+            "validator": saved["validator"],
+            "done": saved["done"] if tracked else None,
+            "changed": False,
+            "lock": threading.Lock(),
+        }
+
+        # Recorded before the file is written, so its content is only trusted for
+        # this version of the file, and its allocated zeros never are
+        self._save_ranges(ranges_path, state)
+        with open(path, "ab") as fp:
+            if parallel:
+                fp.truncate(size)
+
+        def fetch(byte_range):
+            self._fetch(get_url, path, byte_range, stats, state, ranges_path)
+            if tracked:
+                with state["lock"]:
+                    state["done"].append(byte_range)
+                    self._save_ranges(ranges_path, state)
+
+        try:
+            with ThreadPoolExecutor(self.workers) as executor:
+                for _ in executor.map(fetch, pending):
+                    pass
+        except Exception:
+            if state["changed"]:
+                # Resumed next time from the start of the new version
+                os.remove(path)
+                os.remove(ranges_path)
+            raise
+
+        if os.path.getsize(path) != size:
+            raise IOError(f"Downloaded {os.path.getsize(path)} bytes, expected {size}.")
+        os.remove(ranges_path)
+
+        stats["elapsed"] = time.perf_counter() - start
+        stats["throughput"] = (
+            stats["bytes"] / stats["elapsed"] if stats["elapsed"] else 0.0
+        )
+        log.debug(
+            "Downloaded %s: %d bytes (%d resumed), %.2f MB/s, %d retries.",
+            path,
+            stats["bytes"],
+            stats["resumed"],
+            stats["throughput"] / 1e6,
+            stats["retries"],
+        )
+        return stats
+
+    def _fetch(self, get_url, path, byte_range, stats, state, ranges_path):
+        first, last = byte_range
+        pos = [first]
+        lock = state["lock"]
+
+        def request():
+            headers = {"Range": f"bytes={pos[0]}-{last}"}
+            validator = state["validator"]
+            if validator:
+                # The server sends the whole file instead if it changed
+                headers["If-Range"] = validator
+            http_request = urllib.request.Request(get_url(), headers=headers)
+            with urllib.request.urlopen(http_request, timeout=self.timeout) as response:
+                if response.status != 206 and validator:
+                    state["changed"] = True
+                    raise IOError(f"The file changed on the server since {validator}.")
+                if response.status != 206 and pos[0] != 0:
+                    raise ValueError("The server does not support range requests.")
+                self._keep_validator(response, state, ranges_path)
+                with open(path, "r+b") as fp:
+                    fp.seek(pos[0])
+                    while pos[0] <= last:
+                        chunk = response.read(min(self.chunk_size, last - pos[0] + 1))
+                        if not chunk:
+                            raise http.client.IncompleteRead(b"", last - pos[0] + 1)
+                        fp.write(chunk)
+                        pos[0] += len(chunk)
+                        with lock:
+                            stats["bytes"] += len(chunk)
+
+        def count_retry(attempt, exc):
+            with lock:
+                stats["retries"] += 1
+
+        call_with_retry(
+            request,
+            retries=self.retries,
+            on_retry=count_retry,
+            is_transient=is_transient_download_error,
+        )
+
+    def _keep_validator(self, response, state, ranges_path):
+        """Record the ETag (or Last-Modified) of the first response, for If-Range."""
+        etag = response.headers.get("ETag")
+        if etag and etag.startswith("W/"):
+            # Weak ETags cannot be used with If-Range
+            etag = None
+        validator = etag or response.headers.get("Last-Modified")
+        with state["lock"]:
+            if validator and not state["validator"]:
+                state["validator"] = validator
+                self._save_ranges(ranges_path, state)
+
+    def _load_ranges(self, path, ranges_path, size, version):
+        """Return what is known of the partial file "path" of this version.
+
+        Returns:
+            dict: The (first, last) byte ranges already downloaded ("done"),
+                whether they were tracked in the ranges file ("tracked") rather
+                than written up to the length of the file, and the ETag or
+                Last-Modified of the file on the server ("validator").
+        """
+        saved = None
+        if os.path.exists(ranges_path):
+            with open(ranges_path, "r") as fp:
+                saved = json.load(fp)
+        if (
+            saved is not None
+            and saved["size"] == size
+            and saved.get("version") == version
+            and os.path.exists(path)
+        ):
+            loaded = {"tracked": True, "validator": saved.get("validator")}
+            if saved["done"] is not None:
+                return dict(loaded, done=[tuple(rng) for rng in saved["done"]])
+            # Downloaded by a single stream, up to the length of the file
+            length = os.path.getsize(path)
+            if length <= size:
+                done = [(0, length - 1)] if length else []
+                return dict(loaded, tracked=False, done=done)
+        # Left by another version of the file, or by an unknown one
+        for stale_path in (path, ranges_path):
+            if os.path.exists(stale_path):
+                os.remove(stale_path)
+        return {"done": [], "tracked": False, "validator": None}
+
+    def _save_ranges(self, ranges_path, state):
+        tmp_path = ranges_path + PARTIAL_SUFFIX
+        saved = {key: state[key] for key in ("size", "version", "validator", "done")}
+        with open(tmp_path, "w") as fp:
+            json.dump(saved, fp)
+        os.replace(tmp_path, ranges_path)
+
+
+class CollectionDownloader:
+    """Download the files of a Collection concurrently, resuming interrupted runs.
+
+    Args:
+        fw_client (flywheel.Client): An active client to a Flywheel instance.
+        root (Path-like): Local directory the files are downloaded to.
+        manifest_path (Path-like, optional): JSON-lines file recording the listing
+            of the Collection, then each downloaded file. If it exists, the run
+            resumes from it instead of listing the Collection again. Defaults to None.
+        workers (int): Number of files downloaded at once. Defaults to
+            DOWNLOAD_WORKERS.
+        verify_hash (bool): Compare the hash of existing local files (see
+            `matches_local_file`) instead of their size only. Defaults to False.
+        retries (int): Max number of retries of a download failing with a transient
+            error. Defaults to API_RETRIES.
+        ranged (RangedDownloader, optional): Downloads the files with range
+            requests, resuming interrupted downloads (of this run or a previous
+            one) instead of starting them over. Defaults to None, to download each
+            file in a single request.
+    """
+
+    def __init__(
+        self,
+        fw_client,
+        root,
+        manifest_path=None,
+        workers=DOWNLOAD_WORKERS,
+        verify_hash=False,
+        retries=API_RETRIES,
+        ranged=None,
+    ):
+        self.fw_client = fw_client
+        self.root = root
+        self.manifest_path = manifest_path
+        self.workers = workers
+        self.verify_hash = verify_hash
+        self.retries = retries
+        self.ranged = ranged
+        self._lock = threading.Lock()
+        self._done = {}
+        self._stats = {}
+        self._start = None
+
+    def run(self, collection, file_type=None):
+        """Download the files of "collection" and return a report.
+
+        Args:
+            collection (flywheel.Collection): The Collection to download. Not
+                listed when resuming from the manifest.
+            file_type (str, optional): Only download files of this type. Defaults
+                to None.
+
+        Returns:
+            dict: The number of files listed, downloaded, skipped (already
+                matching) and failed, the number of bytes downloaded and resumed
+                (already on disk), the number of retries, the elapsed time, the
+                throughput (in bytes per second), the error of each failed file and
+                the bytes, resumed bytes, retries, elapsed time and throughput of
+                each downloaded file, keyed by path.
+        """
+        self._start = time.perf_counter()
+        entries, self._done = self._load_manifest()
+        if entries is None:
+            entries = list_collection_files(
+                self.fw_client, collection, file_type=file_type, workers=self.workers
+            )
+            self._save_listing(entries)
+        self._stats = {
+            "listed": len(entries),
+            "downloaded": 0,
+            "skipped": 0,
+            "failed": 0,
+            "bytes": 0,
+            "resumed": 0,
+            "retries": 0,
+            "errors": {},
+            "files": {},
+        }
+
+        with ThreadPoolExecutor(self.workers) as executor:
+            for _ in executor.map(self._process, entries):
+                pass
+
+        return self._report(time.perf_counter() - self._start)
+
+    def _process(self, entry):
+        path = os.path.join(self.root, entry["path"])
+        # Files downloaded by a previous run are not hashed again
+        if self._done.get(entry["path"]) == entry["modified"]:
+            verify_hash = False
+        else:
+            verify_hash = self.verify_hash
+        if matches_local_file(entry, path, verify_hash=verify_hash):
+            self._count("skipped")
+            self._save_to_manifest(entry)
+            return
+
+        try:
+            stats = self._download(entry, path)
+        except Exception as exc:
+            log.exception("Could not download %s.", entry["path"])
+            with self._lock:
+                self._stats["errors"][entry["path"]] = str(exc)
+            self._count("failed")
+            return
+        with self._lock:
+            self._stats["bytes"] += stats["bytes"]
+            self._stats["resumed"] += stats["resumed"]
+            self._stats["files"][entry["path"]] = {
+                key: stats[key]
+                for key in ("bytes", "resumed", "retries", "elapsed", "throughput")
+            }
+        self._count("downloaded")
+        self._save_to_manifest(entry)
+
+    def _download(self, entry, path):
+        """Download the file of "entry" to "path", and return its download stats."""
+        start = time.perf_counter()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        partial_path = path + PARTIAL_SUFFIX
+        if self.ranged:
+            # The partial file is kept on errors, to be resumed
+            stats = self.ranged.download(
+                functools.partial(self._download_url, entry),
+                partial_path,
+                entry["size"],
+                version=entry["hash"] or entry["modified"],
+            )
+            os.replace(partial_path, path)
+            with self._lock:
+                self._stats["retries"] += stats["retries"]
+            return stats
+
+        retries = 0
+
+        def count_retry(attempt, exc):
+            nonlocal retries
+            retries += 1
+            self._count_retry(attempt, exc)
+
+        try:
+            call_with_retry(
+                functools.partial(
+                    self.fw_client.download_file_from_container,
+                    entry["parent_id"],
+                    entry["name"],
+                    partial_path,
+                ),
+                retries=self.retries,
+                on_retry=count_retry,
+            )
+            size = os.path.getsize(partial_path)
+            if size != entry["size"]:
+                raise IOError(f"Downloaded {size} bytes, expected {entry['size']}.")
+            os.replace(partial_path, path)
+        except Exception:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            raise
+        elapsed = time.perf_counter() - start
+        return {
+            "bytes": entry["size"],
+            "resumed": 0,
+            "retries": retries,
+            "elapsed": elapsed,
+            "throughput": entry["size"] / elapsed if elapsed else 0.0,
+        }
+
+    def _download_url(self, entry):
+        url = self.fw_client.get_container_download_url(
+            entry["parent_id"], entry["name"]
+        )
+        # Range requests are only supported when viewing a file
+        separator = "&" if urllib.parse.urlsplit(url).query else "?"
+        return f"{url}{separator}view=true"
+
+    def _count_retry(self, attempt, exc):
+        with self._lock:
+            self._stats["retries"] += 1
+
+    def _count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+            done = sum(self._stats[k] for k in ("downloaded", "skipped", "failed"))
+            downloaded = self._stats["bytes"]
+        if done % DOWNLOAD_LOG_INTERVAL == 0:
+            elapsed = time.perf_counter() - self._start
+            log.info(
+                "%d of %d files done, %.2f MB/s.",
+                done,
+                self._stats["listed"],
+                downloaded / elapsed / 1e6 if elapsed else 0.0,
+            )
+
+    def _load_manifest(self):
+        """Return the listed entries (None if not listed yet) and the done files."""
+        if not self.manifest_path or not os.path.exists(self.manifest_path):
+            return None, {}
+        entries = []
+        done = {}
+        with open(self.manifest_path, "r") as fp:
+            for line in fp:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if "done" in record:
+                    done[record["done"]] = record["modified"]
+                else:
+                    entries.append(record)
+        log.info(
+            "Resuming, %d files listed, %d already downloaded.", len(entries), len(done)
+        )
+        return entries, done
+
+    def _save_listing(self, entries):
+        if not self.manifest_path:
+            return
+        # Renamed once complete, so an existing manifest always has the full listing
+        tmp_path = str(self.manifest_path) + PARTIAL_SUFFIX
+        with open(tmp_path, "w") as fp:
+            for entry in entries:
+                fp.write(json.dumps(entry) + "\n")
+        os.replace(tmp_path, self.manifest_path)
+
+    def _save_to_manifest(self, entry):
+        if not self.manifest_path or self._done.get(entry["path"]) == entry["modified"]:
+            return
+        with self._lock:
+            with open(self.manifest_path, "a") as fp:
+                record = {"done": entry["path"], "modified": entry["modified"]}
+                fp.write(json.dumps(record) + "\n")
+
+    def _report(self, elapsed):
+        report = dict(self._stats)
+        report["elapsed"] = elapsed
+        report["throughput"] = report["bytes"] / elapsed if elapsed else 0.0
+        log.info(
+            "Downloaded %d files (%.2f GB) in %.2f s (%.2f MB/s, %d skipped, "
+            "%d failed, %d retries).",
+            report["downloaded"],
+            report["bytes"] / 1e9,
+            elapsed,
+            report["throughput"] / 1e6,
+            report["skipped"],
+            report["failed"],
+            report["retries"],
+        )
+        return report
@@ -0,0 +1,520 @@
+"""
+The following are helper functions to submit gear jobs in bulk.
+
+A producer walks the Project hierarchy and yields (gear, inputs, destination)
+requests, which a bounded pool of worker threads submits concurrently:
+
+    requests = iter_gear_requests(project, gear, "nifti", file_type="nifti")
+    report = BatchJobSubmitter(fw, manifest_path="mriqc_jobs.jsonl").run(requests)
+
+Submissions failing with a transient error (5xx) are retried with backoff. A
+request is skipped if a job already exists (or was already submitted in the run)
+for the same gear version and input files, and every submitted job is recorded in
+a JSON-lines manifest so an interrupted batch can be resumed.
+
+`BulkJobExecutor` retries or cancels many jobs, e.g. all the failed jobs of a
+gear, concurrently and under a rate limit:
+
+    job_ids = iter_job_ids(fw, "gear_info.name=mriqc,state=failed")
+    report = BulkJobExecutor(fw, "retry", report_path="retried.jsonl").run(job_ids)
+"""
+import functools
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from api_helpers import API_RETRIES, TokenBucket, call_with_retry
+
+log = logging.getLogger(__name__)
+
+# Number of jobs submitted at once
+SUBMIT_WORKERS = 8
+
+# Max number of requests waiting for a worker
+SUBMIT_QUEUE_SIZE = 64
+
+# Jobs in those states are not submitted again
+EXISTING_JOB_STATES = ("pending", "running", "complete")
+
+# Actions of a BulkJobExecutor
+JOB_ACTIONS = ("retry", "cancel")
+
+# Number of job actions sent at once, and max number of requests per second
+JOB_ACTION_WORKERS = 8
+JOB_ACTION_RATE = 10
+
+# Number of job actions between two progress logs
+JOB_ACTION_LOG_INTERVAL = 100
+
+# Marks the end of the requests in the queue
+_DONE = object()
+
+
+def iter_gear_requests(
+    project, gear, input_name, file_type=None, file_filter=None, max_acquisitions=None
+):
+    """Walk the Acquisitions of a Project and yield a request per matching file.
+
+    Args:
+        project (flywheel.Project): The Project to walk.
+        gear (flywheel.Gear): The gear to run.
+        input_name (str): The manifest input label of the gear the file is given to.
+        file_type (str, optional): Only yield files of this type (e.g. "dicom").
+            Defaults to None.
+        file_filter (callable, optional): Only yield the files for which it returns
+            True. Defaults to None.
+        max_acquisitions (int, optional): Max number of Acquisitions walked per
+            Session. Defaults to None, for all of them.
+
+    Yields:
+        tuple: The gear, its inputs and the destination (the Acquisition of the file).
+    """
+    for session in project.sessions.iter():
+        for i, acq in enumerate(session.acquisitions.iter()):
+            if max_acquisitions is not None and i >= max_acquisitions:
+                break
+            for file_obj in acq.files:
+                if file_type and file_obj.type != file_type:
+                    continue
+                if file_filter and not file_filter(file_obj):
+                    continue
+                yield gear, {input_name: file_obj}, acq
+
+
+def request_key(gear, inputs):
+    """Return the key identifying a job by its gear version and input files.
+
+    Args:
+        gear (flywheel.Gear): The gear to run.
+        inputs (dict): The input files of the job, keyed by manifest input label.
+
+    Returns:
+        str: The gear id, then the parent id and name of each input file.
+    """
+    files = sorted(
+        f"{name}={file_obj.parent.id}/{file_obj.name}"
+        for name, file_obj in inputs.items()
+    )
+    return "|".join([gear.id] + files)
+
+
+def job_key(job):
+    """Return the key of an existing job, as `request_key` does for a request.
+
+    Args:
+        job (flywheel.Job): A job, as returned by `fw_client.jobs.iter_find()`.
+
+    Returns:
+        str: The gear id, then the parent id and name of each input file.
+    """
+    files = sorted(
+        f"{name}={val['hierarchy']['id']}/{val['location']['name']}"
+        for name, val in (job.config.get("inputs") or {}).items()
+        if "hierarchy" in val
+    )
+    return "|".join([job.gear_id] + files)
+
+
+class BatchJobSubmitter:
+    """Submit gear jobs concurrently, skipping the jobs that already exist.
+
+    Args:
+        fw_client (flywheel.Client): An active client to a Flywheel instance.
+        manifest_path (Path-like, optional): File recording the key and id of each
+            submitted job. Requests found in it are skipped, so an interrupted batch
+            can be resumed. Defaults to None.
+        workers (int): Number of jobs submitted at once. Defaults to SUBMIT_WORKERS.
+        queue_size (int): Max number of requests waiting for a worker. Defaults to
+            SUBMIT_QUEUE_SIZE.
+        skip_existing (bool): Skip the requests for which a job in
+            EXISTING_JOB_STATES exists with the same gear version and inputs. The
+            jobs of each gear are listed once, which requires being a site admin:
+            otherwise a warning is logged and no job is skipped. Defaults to True.
+        retries (int): Max number of retries of a submission failing with a
+            transient error. Defaults to API_RETRIES.
+        config (dict, optional): Configuration of the jobs. Defaults to None, for
+            the gear's defaults.
+        tags (list, optional): Tags of the jobs. Defaults to None.
+    """
+
+    def __init__(
+        self,
+        fw_client,
+        manifest_path=None,
+        workers=SUBMIT_WORKERS,
+        queue_size=SUBMIT_QUEUE_SIZE,
+        skip_existing=True,
+        retries=API_RETRIES,
+        config=None,
+        tags=None,
+    ):
+        self.fw_client = fw_client
+        self.manifest_path = manifest_path
+        self.workers = workers
+        self.queue_size = queue_size
+        self.skip_existing = skip_existing
+        self.retries = retries
+        self.config = config
+        self.tags = tags
+        self._lock = threading.Lock()
+        self._gear_locks = {}
+        self._loaded_gears = set()
+        self._submitted = {}
+        self._existing = {}
+        self._stats = {}
+
+    def run(self, requests):
+        """Submit the jobs of "requests" and return a report.
+
+        Args:
+            requests (iterable): (gear, inputs, destination) tuples, e.g. from
+                `iter_gear_requests`.
+
+        Returns:
+            dict: The number of jobs submitted, skipped (from the manifest),
+                existing and failed, the number of retries, the elapsed time, the
+                throughput, the latency of the submissions, the job id of each
+                request and the error of each failed request.
+        """
+        self._submitted = self._load_manifest()
+        self._existing = {}
+        self._loaded_gears = set()
+        self._stats = {
+            "submitted": 0,
+            "skipped": 0,
+            "existing": 0,
+            "failed": 0,
+            "retries": 0,
+            "latencies": [],
+            "job_ids": {},
+            "errors": {},
+        }
+        start = time.perf_counter()
+
+        requests_queue = queue.Queue(maxsize=self.queue_size)
+        threads = [
+            threading.Thread(target=self._work, args=(requests_queue,), daemon=True)
+            for _ in range(self.workers)
+        ]
+        for thread in threads:
+            thread.start()
+
+        # Blocks while the workers are behind
+        for request in requests:
+            requests_queue.put(request)
+        requests_queue.put(_DONE)
+
+        for thread in threads:
+            thread.join()
+
+        return self._report(time.perf_counter() - start)
+
+    def _work(self, requests_queue):
+        while True:
+            request = requests_queue.get()
+            if request is _DONE:
+                # Let the other workers stop too
+                requests_queue.put(_DONE)
+                return
+
+            try:
+                gear, inputs, destination = request
+                key = request_key(gear, inputs)
+            except Exception as exc:
+                # Counted as failed, so the workers keep draining the queue
+                log.exception("Invalid request %r.", request)
+                self._count_failure(repr(request), exc)
+                continue
+            if key in self._submitted:
+                with self._lock:
+                    self._stats["skipped"] += 1
+                    self._stats["job_ids"][key] = self._submitted[key]
+                continue
+
+            if self.skip_existing:
+                try:
+                    self._load_existing_jobs(gear)
+                except Exception as exc:
+                    log.exception("Could not list the jobs of gear %s.", gear.id)
+                    self._count_failure(key, exc)
+                    continue
+            if not self._claim(key):
+                with self._lock:
+                    self._stats["existing"] += 1
+                    # None for a duplicate request still being submitted
+                    if self._existing[key]:
+                        self._stats["job_ids"].setdefault(key, self._existing[key])
+                continue
+
+            try:
+                job_id = call_with_retry(
+                    functools.partial(self._submit, gear, inputs, destination),
+                    retries=self.retries,
+                    on_retry=self._count_retry,
+                )
+            except Exception as exc:
+                log.exception("Could not submit a job for %s.", key)
+                with self._lock:
+                    self._existing.pop(key, None)
+                self._count_failure(key, exc)
+                continue
+
+            with self._lock:
+                self._existing[key] = job_id
+                self._stats["submitted"] += 1
+                self._stats["job_ids"][key] = job_id
+            self._save_to_manifest(key, job_id)
+
+    def _submit(self, gear, inputs, destination):
+        start = time.perf_counter()
+        try:
+            return gear.run(
+                config=self.config,
+                inputs=inputs,
+                destination=destination,
+                tags=self.tags,
+            )
+        finally:
+            with self._lock:
+                self._stats["latencies"].append(time.perf_counter() - start)
+
+    def _count_retry(self, attempt, exc):
+        with self._lock:
+            self._stats["retries"] += 1
+
+    def _count_failure(self, key, exc):
+        with self._lock:
+            self._stats["failed"] += 1
+            self._stats["errors"][key] = str(exc)
+
+    def _claim(self, key):
+        """Reserve "key" for this worker, unless its job exists or is being submitted."""
+        with self._lock:
+            if key in self._existing:
+                return False
+            self._existing[key] = None
+            return True
+
+    def _load_existing_jobs(self, gear):
+        with self._lock:
+            gear_lock = self._gear_locks.setdefault(gear.id, threading.Lock())
+        with gear_lock:
+            if gear.id in self._loaded_gears:
+                return
+            try:
+                jobs = call_with_retry(
+                    lambda: list(self.fw_client.jobs.iter_find(f"gear_id={gear.id}")),
+                    retries=self.retries,
+                    on_retry=self._count_retry,
+                )
+            except Exception as exc:
+                if getattr(exc, "status", None) != 403:
+                    raise
+                # Listing jobs is reserved to site admins
+                log.warning(
+                    "Not allowed to list the jobs of gear %s, existing jobs will not "
+                    "be skipped.",
+                    gear.id,
+                )
+                jobs = []
+            existing = {
+                job_key(job): job.id for job in jobs if job.state in EXISTING_JOB_STATES
+            }
+            with self._lock:
+                for key, job_id in existing.items():
+                    self._existing.setdefault(key, job_id)
+                self._loaded_gears.add(gear.id)
+            log.info("Found %d existing jobs for gear %s.", len(existing), gear.id)
+
+    def _load_manifest(self):
+        if not self.manifest_path or not os.path.exists(self.manifest_path):
+            return {}
+        with open(self.manifest_path, "r") as fp:
+            entries = [json.loads(line) for line in fp if line.strip()]
+        log.info("Resuming, %d jobs already submitted.", len(entries))
+        return {entry["key"]: entry["job_id"] for entry in entries}
+
+    def _save_to_manifest(self, key, job_id):
+        if not self.manifest_path:
+            return
+        with self._lock:
+            with open(self.manifest_path, "a") as fp:
+                fp.write(json.dumps({"key": key, "job_id": job_id}) + "\n")
+
+    def _report(self, elapsed):
+        stats = self._stats
+        latencies = sorted(stats.pop("latencies"))
+        report = dict(stats)
+        report["elapsed"] = elapsed
+        report["throughput"] = stats["submitted"] / elapsed if elapsed else 0.0
+        report["latency"] = {
+            "mean": sum(latencies) / len(latencies) if latencies else 0.0,
+            "p50": latencies[len(latencies) // 2] if latencies else 0.0,
+            "p95": latencies[int(len(latencies) * 0.95)] if latencies else 0.0,
+            "max": latencies[-1] if latencies else 0.0,
+        }
+        log.info(
+            "Submitted %d jobs in %.2f s (%.2f jobs/s, %d skipped, %d existing, "
+            "%d failed, %d retries).",
+            report["submitted"],
+            elapsed,
+            report["throughput"],
+            report["skipped"],
+            report["existing"],
+            report["failed"],
+            report["retries"],
+        )
+        log.info(
+            "Submission latency: mean %.3f s, p50 %.3f s, p95 %.3f s, max %.3f s.",
+            report["latency"]["mean"],
+            report["latency"]["p50"],
+            report["latency"]["p95"],
+            report["latency"]["max"],
+        )
+        return report
+
+
+def iter_job_ids(fw_client, job_filter):
+    """Yield the ids of the jobs matching "job_filter", e.g. "state=failed"."""
+    for job in fw_client.jobs.iter_find(job_filter):
+        yield job.id
+
+
+class BulkJobExecutor:
+    """Retry or cancel many jobs concurrently, under a rate limit.
+
+    Requests failing with a transient error (5xx) are retried with backoff, and
+    every job gets a result, so no error is silently dropped (e.g. a job that was
+    already retried once).
+
+    Args:
+        fw_client (flywheel.Client): An active client to a Flywheel instance.
+        action (str): "retry" (failed jobs) or "cancel" (pending or running jobs).
+        workers (int): Number of requests sent at once. Defaults to
+            JOB_ACTION_WORKERS.
+        rate (float): Max number of requests per second, retries included.
+            Defaults to JOB_ACTION_RATE.
+        retries (int): Max number of retries of a request failing with a transient
+            error. Defaults to API_RETRIES.
+        report_path (Path-like, optional): JSON-lines file the result of each job is
+            appended to. Defaults to None.
+        on_progress (callable, optional): Called with the progress (see `progress`)
+            after each job. Defaults to None.
+    """
+
+    def __init__(
+        self,
+        fw_client,
+        action,
+        workers=JOB_ACTION_WORKERS,
+        rate=JOB_ACTION_RATE,
+        retries=API_RETRIES,
+        report_path=None,
+        on_progress=None,
+    ):
+        if action not in JOB_ACTIONS:
+            raise ValueError(f"action must be one of {JOB_ACTIONS}, not {action!r}.")
+        self.fw_client = fw_client
+        self.action = action
+        self.workers = workers
+        self.bucket = TokenBucket(rate)
+        self.retries = retries
+        self.report_path = report_path
+        self.on_progress = on_progress
+        self.results = {}
+        self.requests = 0
+        self.succeeded = 0
+        self._start = None
+        self._lock = threading.Lock()
+
+    def progress(self):
+        """Return the number of jobs done, succeeded and failed, and the throughput.
+
+        Returns:
+            dict: "done", "succeeded", "failed", "requests" (retries included),
+                "elapsed" (in seconds) and "throughput" (jobs per second).
+        """
+        with self._lock:
+            done = len(self.results)
+            succeeded = self.succeeded
+            requests = self.requests
+        elapsed = time.perf_counter() - self._start if self._start else 0.0
+        return {
+            "done": done,
+            "succeeded": succeeded,
+            "failed": done - succeeded,
+            "requests": requests,
+            "elapsed": elapsed,
+            "throughput": done / elapsed if elapsed else 0.0,
+        }
+
+    def run(self, job_ids):
+        """Apply the action to "job_ids" and return a report.
+
+        Args:
+            job_ids (iterable): Ids of the jobs, e.g. from `iter_job_ids`.
+
+        Returns:
+            dict: The progress at the end (see `progress`) and the result of each
+                job: whether it succeeded, the id of the new job (for "retry"),
+                the error and the number of attempts.
+        """
+        self.results = {}
+        self.requests = 0
+        self.succeeded = 0
+        self._start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for _ in executor.map(self._apply, job_ids):
+                pass
+
+        report = self.progress()
+        report["results"] = dict(self.results)
+        log.info(
+            "%s %d of %d jobs in %.2f s (%.2f jobs/s, %d requests).",
+            "Retried" if self.action == "retry" else "Cancelled",
+            report["succeeded"],
+            report["done"],
+            report["elapsed"],
+            report["throughput"],
+            report["requests"],
+        )
+        return report
+
+    def _apply(self, job_id):
+        attempts = [0]
+
+        def request():
+            self.bucket.acquire()
+            attempts[0] += 1
+            with self._lock:
+                self.requests += 1
+            if self.action == "retry":
+                return self.fw_client.retry_job(job_id)
+            return self.fw_client.modify_job(job_id, {"state": "cancelled"})
+
+        result = {"job_id": job_id, "action": self.action, "ok": True}
+        try:
+            response = call_with_retry(request, retries=self.retries)
+            if self.action == "retry":
+                result["new_job_id"] = getattr(response, "id", response)
+        except Exception as exc:
+            log.error("Could not %s job %s: %s", self.action, job_id, exc)
+            result["ok"] = False
+            result["error"] = str(exc)
+        result["attempts"] = attempts[0]
+
+        with self._lock:
+            self.results[job_id] = result
+            self.succeeded += result["ok"]
+            done = len(self.results)
+            if self.report_path:
+                with open(self.report_path, "a") as fp:
+                    fp.write(json.dumps(result) + "\n")
+        if done % JOB_ACTION_LOG_INTERVAL == 0:
+            log.info("%d jobs done, %.2f jobs/s.", done, self.progress()["throughput"])
+        if self.on_progress:
+            self.on_progress(self.progress())
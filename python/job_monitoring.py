@@ -0,0 +1,684 @@
+"""
+The following are helper functions to monitor many Flywheel jobs.
+
+`JobTracker` keeps the state of the tracked jobs in memory. Instead of getting
+each job on every poll, it refreshes its table with one bulk query for the jobs
+modified since its last sync, so the cost of a poll grows with the number of
+jobs that changed, not with the number of jobs tracked:
+
+    tracker = JobTracker(fw, job_ids, query="gear_info.name=mriqc")
+    tracker.subscribe(lambda job, old_state: print(job.id, job.state), FINAL_STATES)
+    tracker.wait()
+
+`RunTimeStore` keeps the run times of the completed jobs of each gear, and the
+statistics the cutoff of a stuck job is computed from, in a NumPy file. Each
+update only fetches the jobs completed since the previous one:
+
+    store = RunTimeStore("run_times.npz")
+    store.update(fw, "mriqc")
+    cutoff = store.cutoff("mriqc")
+
+`StuckJobWatchdog` combines both to cancel the running jobs of a gear that run for
+longer than the cutoff, only re-checking jobs whose deadline has passed:
+
+    StuckJobWatchdog(fw, "mriqc", store=store).run()
+"""
+import datetime
+import heapq
+import json
+import logging
+import math
+import os
+import threading
+import time
+from collections import Counter
+
+import numpy as np
+
+from api_helpers import format_timestamp
+from job_helpers import BulkJobExecutor
+
+log = logging.getLogger(__name__)
+
+# States a job does not leave (except by being retried as a new job)
+FINAL_STATES = ("complete", "failed", "cancelled")
+
+# States of the jobs still to be run
+ACTIVE_STATES = ("pending", "running")
+
+# Number of job ids per query when loading the jobs tracked by id
+JOB_ID_CHUNK_SIZE = 100
+
+# Time (in seconds) the modified window of a sync overlaps the previous one, so
+# jobs modified while the previous sync was running are not missed
+SYNC_OVERLAP = 60
+
+# Time (in seconds) between two syncs in `JobTracker.wait`
+POLL_INTERVAL = 30
+
+# Initial number of run times a GearRunTimes has room for, doubled when full
+RUN_TIME_CAPACITY = 1024
+
+# Relative accuracy of the quantiles of run times, and number of sketch bins
+# (enough for run times up to a few years at 1%)
+SKETCH_ACCURACY = 0.01
+SKETCH_BINS = 2048
+
+# Min and max time (in seconds) the watchdog sleeps between two checks
+WATCHDOG_MIN_SLEEP = 5
+WATCHDOG_MAX_SLEEP = 60
+
+# Time (in seconds) between two updates of the run times by the watchdog
+WATCHDOG_STATS_INTERVAL = 600
+
+# Number of jobs the watchdog cancels or retries at once
+WATCHDOG_WORKERS = 8
+
+# Min number of run times to test for normality, and p-value under which the
+# run times are not considered normally distributed
+NORMALITY_MIN_COUNT = 20
+NORMALITY_PVALUE = 0.01
+
+
+class JobTracker:
+    """In-memory table of the states of many jobs, refreshed with bulk queries.
+
+    Jobs are tracked by id, or by a query: with `job_ids`, only those jobs are
+    tracked, and `query` narrows the sync queries (e.g. to the gear of the jobs).
+    Without `job_ids`, all the jobs matching `query` are tracked, including the
+    ones created later.
+
+    Listing jobs is reserved to site admins. For other users, the sync queries
+    fall back to `get_current_user_jobs`, so only their own jobs can be tracked.
+
+    Args:
+        fw_client (flywheel.Client): An active client to a Flywheel instance.
+        job_ids (iterable, optional): Ids of the jobs to track. Defaults to None.
+        query (str, optional): A job filter, e.g. "gear_info.name=mriqc". Defaults
+            to None.
+        states (iterable): When tracking by query, states of the jobs loaded by the
+            first sync. Defaults to ACTIVE_STATES.
+    """
+
+    def __init__(self, fw_client, job_ids=None, query=None, states=ACTIVE_STATES):
+        self.fw_client = fw_client
+        self.query = query
+        self.states = tuple(states)
+        self.by_query = job_ids is None
+        self.jobs = {}
+        self.last_modified = None
+        self.queries = 0
+        # Set once listing the jobs of all users was not allowed
+        self.user_jobs_only = False
+        self._new_ids = set(job_ids or ())
+        self._subscribers = []
+        self._lock = threading.RLock()
+
+    def track(self, job_ids):
+        """Track more jobs, e.g. the jobs just submitted. Loaded by the next sync."""
+        with self._lock:
+            self._new_ids.update(set(job_ids) - set(self.jobs))
+
+    def subscribe(self, callback, states=None):
+        """Call "callback" with each job changing state, and its previous state.
+
+        Args:
+            callback (callable): Called with the job and its previous state (None
+                for a job loaded for the first time).
+            states (iterable, optional): Only call it for jobs entering one of these
+                states. Defaults to None, for all the transitions.
+
+        Returns:
+            callable: The callback, to unsubscribe it.
+        """
+        with self._lock:
+            self._subscribers.append((callback, frozenset(states or ())))
+        return callback
+
+    def unsubscribe(self, callback):
+        """Stop calling "callback" on state transitions."""
+        with self._lock:
+            self._subscribers = [s for s in self._subscribers if s[0] is not callback]
+
+    def sync(self):
+        """Fetch the jobs modified since the last sync and update their states.
+
+        Returns:
+            list: (job, previous state) of each job that changed state.
+        """
+        with self._lock:
+            if self.last_modified is None:
+                jobs = self._load()
+            else:
+                since = self.last_modified - datetime.timedelta(seconds=SYNC_OVERLAP)
+                jobs = list(self._find(f"modified>{format_timestamp(since)}"))
+                if self._new_ids:
+                    jobs.extend(self._load_ids())
+
+            transitions = []
+            for job in jobs:
+                if job.modified and (
+                    self.last_modified is None or job.modified > self.last_modified
+                ):
+                    self.last_modified = job.modified
+                if job.id not in self.jobs and not (
+                    self.by_query or job.id in self._new_ids
+                ):
+                    continue
+                self._new_ids.discard(job.id)
+                previous = self.jobs.get(job.id)
+                self.jobs[job.id] = job
+                old_state = previous.state if previous is not None else None
+                if job.state != old_state:
+                    transitions.append((job, old_state))
+
+            if self.last_modified is None:
+                # Nothing loaded yet, start the next window from now
+                self.last_modified = datetime.datetime.now(datetime.timezone.utc)
+            subscribers = list(self._subscribers)
+
+        for job, old_state in transitions:
+            for callback, states in subscribers:
+                if not states or job.state in states:
+                    callback(job, old_state)
+        log.debug("Synced %d jobs, %d transitions.", len(jobs), len(transitions))
+        return transitions
+
+    def counts(self):
+        """Return the number of tracked jobs in each state."""
+        with self._lock:
+            return Counter(job.state for job in self.jobs.values())
+
+    def get_jobs(self, *states):
+        """Return the tracked jobs in any of "states", or all of them."""
+        with self._lock:
+            return [
+                job for job in self.jobs.values() if not states or job.state in states
+            ]
+
+    def done(self):
+        """Return True if all the tracked jobs are in a final state."""
+        with self._lock:
+            return not self._new_ids and all(
+                job.state in FINAL_STATES for job in self.jobs.values()
+            )
+
+    def wait(self, poll_interval=POLL_INTERVAL, timeout=None):
+        """Sync until all the tracked jobs are in a final state.
+
+        Args:
+            poll_interval (float): Time (in seconds) between two syncs. Defaults to
+                POLL_INTERVAL.
+            timeout (float, optional): Max time (in seconds) to wait. Defaults to
+                None, to wait for as long as it takes.
+
+        Returns:
+            bool: True if all the jobs are in a final state, False on timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            self.sync()
+            if self.done():
+                return True
+            if deadline is not None and time.monotonic() + poll_interval > deadline:
+                return False
+            time.sleep(poll_interval)
+
+    def _find(self, job_filter, narrow=True):
+        self.queries += 1
+        if narrow and self.query:
+            job_filter = f"{self.query},{job_filter}"
+        if not self.user_jobs_only:
+            try:
+                return list(self.fw_client.jobs.iter_find(job_filter))
+            except Exception as exc:
+                if getattr(exc, "status", None) != 403:
+                    raise
+                log.warning(
+                    "Not allowed to list the jobs of all users, only tracking the "
+                    "jobs of the current user."
+                )
+                self.user_jobs_only = True
+        return self.fw_client.get_current_user_jobs(filter=job_filter)["jobs"]
+
+    def _load(self):
+        if self.by_query:
+            return list(self._find(f"state=|[{','.join(self.states)}]"))
+        return self._load_ids()
+
+    def _load_ids(self):
+        job_ids = sorted(self._new_ids)
+        jobs = []
+        for i in range(0, len(job_ids), JOB_ID_CHUNK_SIZE):
+            chunk = job_ids[i : i + JOB_ID_CHUNK_SIZE]
+            jobs.extend(self._find(f"_id=|[{','.join(chunk)}]", narrow=False))
+        missing = set(job_ids) - {job.id for job in jobs}
+        if missing:
+            log.warning("Jobs %s not found, not tracked.", sorted(missing))
+            self._new_ids -= missing
+        return jobs
+
+
+class GearRunTimes:
+    """Run times (in seconds) of the completed jobs of a gear, and their statistics.
+
+    Run times are kept in a NumPy array. The mean and variance are updated with
+    Welford's algorithm (merged batch by batch), and quantiles are estimated from a
+    log-binned sketch with a relative accuracy of SKETCH_ACCURACY. The cutoff
+    beyond which a running job is considered stuck is recomputed on each update,
+    so reading it is O(1):
+
+    - If the run times are normally distributed (enough): mean + 2 sd.
+    - Otherwise: max + 1 sd.
+    """
+
+    _gamma = (1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY)
+    _log_gamma = math.log(_gamma)
+
+    def __init__(self):
+        self._values = np.empty(RUN_TIME_CAPACITY)
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self.sketch = np.zeros(SKETCH_BINS, dtype=np.int64)
+        self.normal = None
+        self.cutoff = None
+
+    @property
+    def values(self):
+        """numpy.ndarray: The run times, in the order they were added."""
+        return self._values[: self.count]
+
+    @property
+    def variance(self):
+        """float: The sample variance of the run times."""
+        return self.m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    @property
+    def std(self):
+        """float: The sample standard deviation of the run times."""
+        return math.sqrt(self.variance)
+
+    def add(self, run_times):
+        """Add run times (in seconds) and update the statistics and the cutoff."""
+        new = np.asarray(run_times, dtype=float)
+        if not new.size:
+            return
+
+        if self.count + new.size > self._values.size:
+            capacity = max(self._values.size * 2, self.count + new.size)
+            self._values = np.resize(self._values, capacity)
+        self._values[self.count : self.count + new.size] = new
+
+        # Merge the mean and sum of squares of the batch (Chan et al.)
+        count = self.count + new.size
+        new_mean = float(new.mean())
+        delta = new_mean - self.mean
+        new_m2 = float(((new - new_mean) ** 2).sum())
+        self.m2 += new_m2 + delta**2 * self.count * new.size / count
+        self.mean += delta * new.size / count
+        self.count = count
+        self.min = min(self.min, float(new.min()))
+        self.max = max(self.max, float(new.max()))
+
+        bins = np.ceil(np.log(np.maximum(new, 1.0)) / self._log_gamma).astype(int)
+        np.add.at(self.sketch, np.minimum(bins, SKETCH_BINS - 1), 1)
+
+        self._update_cutoff()
+
+    def quantile(self, q):
+        """Estimate the "q" quantile (0 <= q <= 1) of the run times from the sketch."""
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        index = int(np.searchsorted(np.cumsum(self.sketch), rank, side="right"))
+        # Middle of the bin, within SKETCH_ACCURACY of the run times in it
+        return min(max(2 * self._gamma**index / (self._gamma + 1), self.min), self.max)
+
+    def summary(self):
+        """Return the statistics of the run times as a dictionary."""
+        return {
+            "count": self.count,
+            "mean": self.mean,
+            "std": self.std,
+            "min": self.min if self.count else None,
+            "max": self.max if self.count else None,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "normal": self.normal,
+            "cutoff": self.cutoff,
+        }
+
+    def _update_cutoff(self):
+        self.normal = self._is_normal()
+        if self.normal:
+            self.cutoff = self.mean + 2 * self.std
+        else:
+            self.cutoff = self.max + self.std
+
+    def _is_normal(self):
+        if self.count < NORMALITY_MIN_COUNT:
+            return False
+        try:
+            from scipy.stats import normaltest
+        except ImportError:
+            log.debug("scipy is not installed, run times are not tested for normality.")
+            return False
+        return bool(normaltest(self.values).pvalue >= NORMALITY_PVALUE)
+
+
+class RunTimeStore:
+    """Run times of the completed jobs of each gear, updated incrementally.
+
+    For each gear, the store keeps a high-water mark: the last modification time
+    of the jobs it ingested. An update only fetches the completed jobs modified
+    after it (to the second), and skips the jobs already ingested, e.g. jobs
+    modified in the same second or modified again after completing (tags,
+    retries...). The run times (from the running to the complete transition) and
+    the ids of the ingested jobs are saved to "path" as NumPy arrays, and the
+    statistics are rebuilt from them on load.
+
+    Args:
+        path (Path-like, optional): The .npz file the store is saved to and loaded
+            from. Defaults to None, for an in-memory store.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.gears = {}
+        self.high_water = {}
+        self.since = {}
+        self.job_ids = {}
+        if path and os.path.exists(path):
+            self.load()
+
+    def get(self, gear_name):
+        """Return the GearRunTimes of "gear_name", empty if none was ingested."""
+        if gear_name not in self.gears:
+            self.gears[gear_name] = GearRunTimes()
+        return self.gears[gear_name]
+
+    def cutoff(self, gear_name):
+        """Return the run time (in seconds) beyond which a job of the gear is stuck.
+
+        Returns:
+            float: The cutoff, or None if no run time of the gear was ingested.
+        """
+        gear = self.gears.get(gear_name)
+        return gear.cutoff if gear else None
+
+    def update(self, fw_client, gear_name, since=None):
+        """Ingest the run times of the jobs of the gear completed since the last update.
+
+        Args:
+            fw_client (flywheel.Client): An active client to a Flywheel instance.
+            gear_name (str): The name of the gear.
+            since (str, optional): Only ingest the jobs created after this date
+                (YYYY-MM-DD). It is recorded on the first update of the gear, and
+                later updates must pass the same date (or None). Defaults to None.
+
+        Returns:
+            int: The number of run times ingested.
+
+        Raises:
+            ValueError: If "since" is not the date the gear's run times were first
+                ingested with.
+        """
+        if gear_name in self.job_ids:
+            if since is not None and since != self.since.get(gear_name):
+                raise ValueError(
+                    f"The {gear_name} run times of the store were ingested since "
+                    f"{self.since.get(gear_name)}, not {since}. Use another store."
+                )
+            since = self.since.get(gear_name)
+
+        job_filter = f"gear_info.name={gear_name},state=complete"
+        if since:
+            job_filter += f",created>{since}"
+        high_water = self.high_water.get(gear_name)
+        if high_water is not None:
+            job_filter += f",modified>{format_timestamp(high_water)}"
+
+        job_ids = self.job_ids.get(gear_name, set())
+        run_times = []
+        for job in fw_client.jobs.iter_find(job_filter):
+            # Jobs modified in the same second, or again after being ingested
+            if job.id in job_ids:
+                continue
+            job_ids.add(job.id)
+            if high_water is None or job.modified > high_water:
+                high_water = job.modified
+            transitions = job.transitions
+            if transitions and transitions.running and transitions.complete:
+                delta = transitions.complete - transitions.running
+                run_times.append(delta.total_seconds())
+
+        self.get(gear_name).add(run_times)
+        self.job_ids[gear_name] = job_ids
+        self.since[gear_name] = since
+        if high_water is not None:
+            self.high_water[gear_name] = high_water
+        if self.path:
+            self.save()
+        log.info("Ingested %d %s run times.", len(run_times), gear_name)
+        return len(run_times)
+
+    def save(self):
+        """Save the run times, ingested job ids and high-water marks to the path."""
+        names = sorted(self.gears)
+        meta = {
+            "gears": names,
+            "high_water": {
+                name: self.high_water[name].isoformat()
+                for name in names
+                if name in self.high_water
+            },
+            "since": {name: self.since.get(name) for name in names},
+        }
+        arrays = {}
+        for i, name in enumerate(names):
+            arrays[f"run_times_{i}"] = self.gears[name].values
+            arrays[f"job_ids_{i}"] = np.array(
+                sorted(self.job_ids.get(name, ())), dtype=str
+            )
+        tmp_path = f"{self.path}.tmp.npz"
+        np.savez(tmp_path, meta=np.array(json.dumps(meta)), **arrays)
+        os.replace(tmp_path, self.path)
+
+    def load(self):
+        """Load the run times, ingested job ids and high-water marks from the path."""
+        with np.load(self.path, allow_pickle=False) as data:
+            meta = json.loads(str(data["meta"]))
+            self.gears = {}
+            self.job_ids = {}
+            for i, name in enumerate(meta["gears"]):
+                self.get(name).add(data[f"run_times_{i}"])
+                self.job_ids[name] = set(data[f"job_ids_{i}"].tolist())
+        self.high_water = {
+            name: datetime.datetime.fromisoformat(value)
+            for name, value in meta["high_water"].items()
+        }
+        self.since = meta["since"]
+
+
+class StuckJobWatchdog:
+    """Cancel the running jobs of a gear that run for longer than its cutoff.
+
+    Running jobs are kept in a heap ordered by their deadline (start of the running
+    state + cutoff), so each check only looks at the jobs whose deadline has
+    passed, and the watchdog sleeps until the next deadline (between `min_sleep`
+    and `max_sleep`). Job states come from a JobTracker, so a check costs one query
+    for the jobs modified since the previous one, and the cutoff from a
+    RunTimeStore, updated every WATCHDOG_STATS_INTERVAL. Stuck jobs (and failed
+    jobs, with `retry_failed`) are cancelled (or retried) in batches, with
+    `workers` requests at once.
+
+    Args:
+        fw_client (flywheel.Client): An active client to a Flywheel instance.
+        gear_name (str): The name of the gear.
+        store (RunTimeStore, optional): The run times of the gear's jobs. Defaults
+            to None, for an in-memory store.
+        query (str, optional): A job filter narrowing the jobs watched, e.g.
+            "created>2020-07-01". Defaults to None.
+        cancel (bool): Cancel the stuck jobs. Defaults to True, False only reports
+            them.
+        retry_failed (bool): Retry the jobs that fail while watched. Defaults to
+            False.
+        instance_stats (bool): Also log the number of jobs in each state on the
+            whole instance, with `fw_client.get_jobs_stats()`. Defaults to False.
+        workers (int): Number of jobs cancelled or retried at once, see
+            BulkJobExecutor. Defaults to WATCHDOG_WORKERS.
+        min_sleep (float): Min time (in seconds) between two checks. Defaults to
+            WATCHDOG_MIN_SLEEP.
+        max_sleep (float): Max time (in seconds) between two checks, so new jobs are
+            seen. Defaults to WATCHDOG_MAX_SLEEP.
+        clock (callable): Returns the current time as a UNIX timestamp. Defaults to
+            time.time.
+    """
+
+    def __init__(
+        self,
+        fw_client,
+        gear_name,
+        store=None,
+        query=None,
+        cancel=True,
+        retry_failed=False,
+        instance_stats=False,
+        workers=WATCHDOG_WORKERS,
+        min_sleep=WATCHDOG_MIN_SLEEP,
+        max_sleep=WATCHDOG_MAX_SLEEP,
+        clock=time.time,
+    ):
+        self.fw_client = fw_client
+        self.gear_name = gear_name
+        self.store = store if store is not None else RunTimeStore()
+        self.cancel = cancel
+        self.instance_stats = instance_stats
+        self.workers = workers
+        self.min_sleep = min_sleep
+        self.max_sleep = max_sleep
+        self.clock = clock
+        job_filter = f"gear_info.name={gear_name}"
+        self.tracker = JobTracker(
+            fw_client, query=f"{job_filter},{query}" if query else job_filter
+        )
+        self.tracker.subscribe(self._on_running, ["running"])
+        if retry_failed:
+            self.tracker.subscribe(self._on_failed, ["failed"])
+        self.cutoff = None
+        self.stuck = []
+        self.retried = []
+        self.errors = {}
+        self._heap = []
+        self._to_retry = []
+        self._stats_time = None
+        # Last modification time seen by the first sync
+        self._first_synced = None
+
+    def tick(self):
+        """Check the jobs once, cancel the stuck ones and retry the failed ones.
+
+        Returns:
+            float: Time (in seconds) to sleep until the next check.
+        """
+        now = self.clock()
+        if (
+            self._stats_time is None
+            or now - self._stats_time >= WATCHDOG_STATS_INTERVAL
+        ):
+            self._stats_time = now
+            self.store.update(self.fw_client, self.gear_name)
+            cutoff = self.store.cutoff(self.gear_name)
+            if cutoff != self.cutoff:
+                self.cutoff = cutoff
+                self._reschedule()
+
+        # Running jobs are pushed to the heap by the tracker's callbacks
+        self.tracker.sync()
+        if self._first_synced is None:
+            self._first_synced = self.tracker.last_modified
+
+        stuck = []
+        while self._heap and self._heap[0][0] <= now:
+            _, start, job_id = heapq.heappop(self._heap)
+            job = self.tracker.jobs.get(job_id)
+            # Jobs that are no longer running are only dropped from the heap here
+            if job is not None and job.state == "running":
+                log.info(
+                    "Job %s running for %.1f min, more than the cutoff of %.1f min.",
+                    job_id,
+                    (now - start) / 60,
+                    self.cutoff / 60,
+                )
+                stuck.append(job_id)
+        self.stuck.extend(stuck)
+
+        if self.cancel:
+            self._apply("cancel", stuck)
+        to_retry, self._to_retry = self._to_retry, []
+        self.retried.extend(self._apply("retry", to_retry))
+
+        counts = self.tracker.counts()
+        log.info(
+            "%d pending, %d running %s jobs, %d stuck.",
+            counts["pending"],
+            counts["running"],
+            self.gear_name,
+            len(stuck),
+        )
+        if self.instance_stats:
+            log.info("Jobs on the instance: %s", self.fw_client.get_jobs_stats())
+
+        next_deadline = self._heap[0][0] if self._heap else math.inf
+        return min(max(next_deadline - self.clock(), self.min_sleep), self.max_sleep)
+
+    def run(self, duration=None):
+        """Check the jobs until interrupted, or for "duration" seconds."""
+        end = None if duration is None else time.monotonic() + duration
+        while end is None or time.monotonic() < end:
+            delay = self.tick()
+            if end is not None:
+                delay = min(delay, max(end - time.monotonic(), 0))
+            time.sleep(delay)
+
+    def _on_running(self, job, old_state):
+        transitions = job.transitions
+        if not transitions or not transitions.running:
+            return
+        start = transitions.running.timestamp()
+        heapq.heappush(self._heap, (self._deadline(start), start, job.id))
+
+    def _on_failed(self, job, old_state):
+        # Jobs that failed before the first sync completed are not retried, even
+        # when seen again in the overlap of the next sync. Jobs that fail later are,
+        # even if created and failed between two syncs.
+        if self._first_synced is not None and job.modified > self._first_synced:
+            self._to_retry.append(job.id)
+
+    def _deadline(self, start):
+        return start + self.cutoff if self.cutoff is not None else math.inf
+
+    def _reschedule(self):
+        self._heap = [
+            (self._deadline(start), start, job_id) for _, start, job_id in self._heap
+        ]
+        heapq.heapify(self._heap)
+
+    def _apply(self, action, job_ids):
+        """Cancel or retry jobs concurrently, and return the ids of the new jobs."""
+        if not job_ids:
+            return []
+        report = BulkJobExecutor(self.fw_client, action, workers=self.workers).run(
+            job_ids
+        )
+        for job_id, result in report["results"].items():
+            if not result["ok"]:
+                self.errors[job_id] = result["error"]
+        return [
+            result["new_job_id"]
+            for result in report["results"].values()
+            if result.get("new_job_id")
+        ]
@@ -1,4 +1,8 @@
 import logging
+import threading
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 
 # Instantiate a logger
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
@@ -26,9 +30,196 @@ PROJECT_MIN_PERM = ['containers_view_metadata',
                     'session_templates_view',
                     'jobs_view']
 
+PROJECT_MIN_ACTIONS = frozenset(PROJECT_MIN_PERM)
+
+# Time (in seconds) a cached permission snapshot stays valid
+PERMISSION_CACHE_TTL = 300
+
+# Max number of permission listings (roles, groups, projects) fetched at once
+PERMISSION_FETCH_WORKERS = 3
+
+
+# Role index
+def build_role_index(roles):
+    """Map each role id to the frozenset of actions the role grants.
+    
+    Args:
+        roles (list): Flywheel roles, as returned by `fw_client.get_all_roles()`.
+        
+    Returns:
+        dict: Frozenset of actions, keyed by role id.
+    
+    """
+    return {role.id: frozenset(role.actions) for role in roles}
+
+
+def compile_project_reqs(min_proj_reqs):
+    """Merge the minimum project requirements with PROJECT_MIN_PERM.
+    
+    Args:
+        min_proj_reqs (list): Minimum project requirements/actions.
+        
+    Returns:
+        frozenset: All the actions required on a project.
+    
+    """
+    return PROJECT_MIN_ACTIONS.union(min_proj_reqs)
+
+
+# Permission cache
+class PermissionSnapshot:
+    """Permissions of the current user, fetched in bulk from a Flywheel instance.
+    
+    The current user, the role table, the group permissions and the project
+    permissions are each fetched once. Every permission check then reads from memory.
+    Once the user is known, the role, group and project listings are fetched
+    concurrently, with at most `max_workers` requests in flight.
+    
+    Args:
+        fw_client (flywheel.client): A Flywheel API Client.
+        max_workers (int): Max number of listings fetched at once. Default to
+            PERMISSION_FETCH_WORKERS, 1 fetches them one at a time.
+        
+    Attributes:
+        user (flywheel.user): Flywheel User modules.
+        role_index (dict): Frozenset of actions of each role, keyed by role id.
+        group_access (dict): Access level of the user, keyed by group id.
+        project_actions (dict): Frozenset of actions the user has, keyed by project label.
+        api_calls (int): Number of API calls made to build the snapshot.
+        load_time (float): Time (in seconds) spent building the snapshot.
+    
+    """
+    
+    def __init__(self, fw_client, max_workers=PERMISSION_FETCH_WORKERS):
+        start = time.perf_counter()
+        self.api_calls = 0
+        self._lock = threading.Lock()
+        
+        self.user = self._counted(fw_client.get_current_user)()
+        user_id = self.user['_id']
+        
+        listings = {'roles': self._counted(fw_client.get_all_roles),
+                    'groups': self._counted(fw_client.groups),
+                    'projects': self._counted(fw_client.projects)}
+        if max_workers > 1:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = {name: executor.submit(fetch) for name, fetch in listings.items()}
+                listings = {name: future.result() for name, future in futures.items()}
+        else:
+            listings = {name: fetch() for name, fetch in listings.items()}
+        
+        self.role_index = build_role_index(listings['roles'])
+        
+        self.group_access = dict()
+        for group in listings['groups']:
+            self.group_access[group.id] = None
+            for perm in group.permissions or []:
+                if perm.id == user_id:
+                    self.group_access[group.id] = perm.access
+                    
+        self.project_actions = dict()
+        # Most projects share the same few role combinations, only merge each once
+        merged_roles = dict()
+        for project in listings['projects']:
+            # Keep the first project found with a label, as `projects.find_first` does
+            if project.label in self.project_actions:
+                continue
+            role_ids = frozenset()
+            for perm in project.permissions or []:
+                if perm.id == user_id:
+                    role_ids = frozenset(perm.role_ids)
+            if role_ids not in merged_roles:
+                merged_roles[role_ids] = frozenset().union(
+                    *(self.role_index.get(role_id, ()) for role_id in role_ids))
+            self.project_actions[project.label] = merged_roles[role_ids]
+        
+        self.load_time = time.perf_counter() - start
+        log.debug('Loaded permissions of user %s with %d API calls in %.3f s',
+                  user_id, self.api_calls, self.load_time)
+        
+    def _counted(self, fetch):
+        """Wrap a client call so each call is counted in `api_calls`."""
+        def call():
+            # Listings may be fetched concurrently
+            with self._lock:
+                self.api_calls += 1
+            return fetch()
+        return call
+
+
+class PermissionCache:
+    """TTL-bounded in-memory cache of permission snapshots, keyed by user id.
+    
+    Args:
+        ttl (float): Time (in seconds) a snapshot stays valid. Default to PERMISSION_CACHE_TTL.
+        clock (callable): Returns the current time in seconds. Default to time.monotonic.
+        max_workers (int): Max number of listings fetched at once when loading a
+            snapshot. Default to PERMISSION_FETCH_WORKERS.
+    
+    """
+    
+    def __init__(self, ttl=PERMISSION_CACHE_TTL, clock=time.monotonic,
+                 max_workers=PERMISSION_FETCH_WORKERS):
+        self.ttl = ttl
+        self.clock = clock
+        self.max_workers = max_workers
+        self._snapshots = dict()
+        # Remember the user of each client so a cache hit needs no API call
+        self._client_users = weakref.WeakKeyDictionary()
+        
+    def get(self, fw_client):
+        """Return the permission snapshot of the user logged in with `fw_client`.
+        
+        Args:
+            fw_client (flywheel.client): A Flywheel API Client.
+            
+        Returns:
+            PermissionSnapshot: A snapshot no older than the cache TTL.
+        
+        """
+        now = self.clock()
+        user_id = self._client_users.get(fw_client)
+        if user_id in self._snapshots:
+            expires_at, snapshot = self._snapshots[user_id]
+            if now < expires_at:
+                return snapshot
+            
+        snapshot = PermissionSnapshot(fw_client, max_workers=self.max_workers)
+        user_id = snapshot.user['_id']
+        self._client_users[fw_client] = user_id
+        self._snapshots[user_id] = (now + self.ttl, snapshot)
+        return snapshot
+    
+    def invalidate(self, user_id=None):
+        """Drop the snapshot of `user_id`, or every snapshot if `user_id` is None."""
+        if user_id is None:
+            self._snapshots.clear()
+        else:
+            self._snapshots.pop(user_id, None)
+            
+            
+# Shared by all the permission checks unless a cache is passed explicitly
+PERMISSION_CACHE = PermissionCache()
+
+
+def get_permission_snapshot(fw_client, cache=None):
+    """Return the cached permission snapshot of the user logged in with `fw_client`.
+    
+    Args:
+        fw_client (flywheel.client): A Flywheel API Client.
+        cache (PermissionCache): Cache to read from. Default to PERMISSION_CACHE.
+        
+    Returns:
+        PermissionSnapshot: The permission snapshot of the current user.
+    
+    """
+    if cache is None:
+        cache = PERMISSION_CACHE
+    return cache.get(fw_client)
+
 
 # Functions
-def check_user_permission(fw_client, min_reqs, group=None, project=None, show_compatible=True):
+def check_user_permission(fw_client, min_reqs, group=None, project=None, show_compatible=True, cache=None):
     """Check if user has the right permission to proceed.
     
     Args:
@@ -37,21 +228,22 @@ def check_user_permission(fw_client, min_reqs, group=None, project=None, show_co
         group (str): Group label. Default to None.
         project (str): Project label. Default to None.
         show_compatible (bool): Print out more information about compatible user permission. Default to True.
+        cache (PermissionCache): Cache to read permissions from. Default to PERMISSION_CACHE.
         
     Returns:
         bool: Returns True if user has the right permission, False otherwise 
     
     """
 
-    has_perm = has_min_permissions(fw_client, min_reqs, group, project)
+    has_perm = has_min_permissions(fw_client, min_reqs, group, project, cache=cache)
     
     # Print out compatible group and project if user's selections do not meet the requirements
     if show_compatible and not has_perm:
-        list_compatible(fw_client, min_reqs)
+        list_compatible(fw_client, min_reqs, cache=cache)
         
     return has_perm
 
-def has_min_permissions(fw_client, min_reqs, group=None, project=None):
+def has_min_permissions(fw_client, min_reqs, group=None, project=None, cache=None):
     """Check whether user meets the minimum permission
     
     Args:
@@ -59,18 +251,19 @@ def has_min_permissions(fw_client, min_reqs, group=None, project=None):
         min_reqs (dict): Minimum requirements.
         group (str): Group label. Default to None.
         project (str): Project label. Default to None.
+        cache (PermissionCache): Cache to read permissions from. Default to PERMISSION_CACHE.
         
     Returns:
     bool: Returns True if user meets the minimum permission, False otherwise
     """
-    user = fw_client.get_current_user()
+    user = get_permission_snapshot(fw_client, cache).user
     
     
     if not has_site_perm(user, min_reqs):
         return False
-    if group and not has_group_perm(fw_client, user,group, min_reqs['group']):
+    if group and not has_group_perm(fw_client, user, group, min_reqs['group'], cache=cache):
         return False
-    if project and not has_project_perm(fw_client, user, project, min_reqs['project']):
+    if project and not has_project_perm(fw_client, user, project, min_reqs['project'], cache=cache):
         return False
     
     # Returns true if site, group and/or project permissions are met
@@ -97,7 +290,7 @@ def has_site_perm(user, min_reqs):
         return False
     
     
-def has_group_perm(fw_client, user, group, group_perm):
+def has_group_perm(fw_client, user, group, group_perm, cache=None):
     """Check if user has the right permission on the group container
     
     Args:
@@ -105,102 +298,120 @@ def has_group_perm(fw_client, user, group, group_perm):
         user (flywheel.user): Flywheel User modules
         group (str): Group label
         group_perm (list): Minimum group permission
+        cache (PermissionCache): Cache to read permissions from. Default to PERMISSION_CACHE.
     
     Returns:
         bool: Returns True if user meets the minimum group permission, False otherwise
     
     """
     
-    group_container = fw_client.lookup(group)
-    group_permission = fw_client.get_group_user_permission(group_container.id, user['_id'])
+    snapshot = get_permission_snapshot(fw_client, cache)
+    if group not in snapshot.group_access:
+        raise ValueError(f'No group found with id: {group}')
+    access = snapshot.group_access[group]
     
-    if GROUP_PERM_ORDER.index(group_permission['access']) >= GROUP_PERM_ORDER.index(group_perm):
+    if access and GROUP_PERM_ORDER.index(access) >= GROUP_PERM_ORDER.index(group_perm):
         return True
     else:
         return False
     
     
-def has_project_perm(fw_client, user, project, min_proj_reqs):
+def has_project_perm(fw_client, user, project, min_proj_reqs, cache=None):
     """Check if user has the right permission on the project container
     
     Args:
         fw_client(flywheel.client): A Flywheel API Client
         user (flywheel.user): Flywheel User modules
         project (str): Project label
-        min_proj_reqs (dict): Minimum project requirements/actions
+        min_proj_reqs (list): Minimum project requirements/actions. A frozenset from
+            `compile_project_reqs` is used as is.
+        cache (PermissionCache): Cache to read permissions from. Default to PERMISSION_CACHE.
     
     Returns:
         bool: Returns True if user meets the minimum project permission, False otherwise
     
     """
     
-    project_container = fw_client.projects.find_first(f'label={project}')
-    if not project_container:
+    snapshot = get_permission_snapshot(fw_client, cache)
+    if project not in snapshot.project_actions:
         raise ValueError(f'No project found labelled: {project}')    
-    user_perms = fw_client.get_project_user_permission(project_container.id, user['_id'])
     
     # Combine all required actions 
-    proj_reqs = list(set(min_proj_reqs) | set(PROJECT_MIN_PERM))
+    if not isinstance(min_proj_reqs, frozenset):
+        min_proj_reqs = compile_project_reqs(min_proj_reqs)
+            
+    return min_proj_reqs <= snapshot.project_actions[project]
     
-    user_actions = list()
     
-    for role_id in user_perms['role_ids']:
-        role = fw_client.get_role(role_id)
-        if user_actions:
-            user_actions = list(set(user_actions) | set(role['actions']))
-        else:
-            user_actions = role['actions']
-            
-    if all(action in user_actions for action in proj_reqs):
-        return True
-    else:
-        return False
     
     
+
+def iter_compatible(fw_client, min_reqs, cache=None):
+    """Yield the containers that meet the minimum requirements as they are found
     
+    Groups are yielded before projects, each in the order Flywheel lists them.
     
+    Args:
+        fw_client(flywheel.client): A Flywheel API Client
+        min_reqs (dict): Minimum requirements
+        cache (PermissionCache): Cache to read permissions from. Default to PERMISSION_CACHE.
+        
+    Yields:
+        tuple: The container type ('group' or 'project') and the group id or project label.
+    
+    """
+    snapshot = get_permission_snapshot(fw_client, cache)
+    user = snapshot.user
+    
+    if 'group' in min_reqs:
+        for group in snapshot.group_access:
+            if has_group_perm(fw_client, user, group, min_reqs['group'], cache=cache):
+                yield 'group', group
+                
+    if 'project' in min_reqs:
+        proj_reqs = compile_project_reqs(min_reqs['project'])
+        for project in snapshot.project_actions:
+            if has_project_perm(fw_client, user, project, proj_reqs, cache=cache):
+                yield 'project', project
+
 
-def list_compatible(fw_client, min_reqs):
+def list_compatible(fw_client, min_reqs, cache=None, on_compatible=None):
     """Provide a list of compatible container that meets the minimum requirements
     
     Args:
         fw_client(flywheel.client): A Flywheel API Client
         min_reqs (dict): Minimum requirements
+        cache (PermissionCache): Cache to read permissions from. Default to PERMISSION_CACHE.
+        on_compatible (callable): Called with the container type and the group id or
+            project label of each compatible container as soon as it is found. Default to None.
 
+    Returns:
+        tuple: The compatible group ids and the compatible project labels.
     
     """
-    user = fw_client.get_current_user()
+    user = get_permission_snapshot(fw_client, cache).user
     
+    if 'site' in min_reqs:
+        if not has_site_perm(user, min_reqs):
+            log.warning(
+                f'Please contact your site admin to get at least {min_reqs["site"]} permission on your Flywheel Instance')
+        else:
+            log.info('You have the right site permission.')
 
-    compatible_group = list()
-    compatible_project = list()
-
-    for container, perms in min_reqs.items():
-        if container == 'site':
-            
-            if not has_site_perm(user, min_reqs):
-                log.warning(
-                    f'Please contact your site admin to get at least {perms} permission on your Flywheel Instance')
-            else:
-                log.info('You have the right site permission.')
-            
-            
-        elif container == 'group':
-            for group in fw_client.groups():
-                if has_group_perm(fw_client, user, group.id, perms):
-                    compatible_group.append(group.id)
-                
-                    
-        elif container == 'project':
-            proj_reqs = list(set(perms) | set(PROJECT_MIN_PERM))
-            for project in fw_client.projects():
-                if has_project_perm(fw_client, user, project.label, proj_reqs):
-                    compatible_project.append(project.label)
-                
+    compatible = {'group': list(), 'project': list()}
+    
+    for container, label in iter_compatible(fw_client, min_reqs, cache=cache):
+        compatible[container].append(label)
+        if on_compatible:
+            on_compatible(container, label)
                 
+    compatible_group = compatible['group']
+    compatible_project = compatible['project']
     if compatible_group:
         group_list = ', '.join(map(str, compatible_group))
         log.info(f'You have the minimum required permission on the following group(s) {group_list}')
     if compatible_project:
         project_list = ', '.join(map(str, compatible_project))
         log.info(f'You have the minimum required permission on the following project(s) {project_list}')
+        
+    return compatible_group, compatible_project